@@ -8,7 +8,7 @@ from mboxparser.utils import OpenFileOrSTDStreams, stdin_or_existing_file
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument('-i', '--input', type=stdin_or_existing_file, default='-', metavar='FILENAME',
-                        help='JSON file name (default: STDIN)')
+                        help='JSON file or header store (--header_db) name (default: STDIN)')
     parser.add_argument('-o', '--output', type=str, metavar='FILENAME', default='-',
                         help='File to write the output into (default: STDOUT)')
     parser.add_argument('-r', '--header', type=str, required=True,
@@ -0,0 +1,135 @@
+import os
+import sys
+import platform
+import subprocess
+from time import perf_counter
+from pathlib import Path
+from hashlib import blake2b
+from datetime import datetime
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from json import dump as json_dump, load as json_load
+
+from mboxparser.utils import existing_file, positive_int
+from benchmarks.generate_mbox import generate_mbox
+from benchmarks.stages import STAGES, Corpus
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+# Name -> mboxparser arguments of the end-to-end runs
+END_TO_END_RUNS = {'end_to_end_headers': ['-t', '--lenient_dates'],
+                   'end_to_end_payload': ['-k', '-f', '-t', '--lenient_dates']}
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--mbox_file', type=existing_file, default=None, metavar='FILENAME.MBOX',
+                        help='MBOX file to benchmark on (default: a generated one)')
+    parser.add_argument('-n', '--messages', type=positive_int, default=2000, metavar='N',
+                        help='Number of messages in the generated MBOX file (default: 2000)')
+    parser.add_argument('-s', '--seed', type=int, default=42,
+                        help='Random seed of the generated MBOX file (default: 42)')
+    parser.add_argument('-o', '--output', type=str, default='-', metavar='FILENAME.JSON',
+                        help='File to write the results into (default: STDOUT)')
+    parser.add_argument('-r', '--repeat', type=positive_int, default=5, metavar='N',
+                        help='Number of repetitions, the fastest one is kept (default: 5)')
+    parser.add_argument('--stages', nargs='+', choices=[*STAGES.keys(), *END_TO_END_RUNS.keys()], default=None,
+                        help='Run only these stages (default: all)')
+    parser.add_argument('-w', '--workers', type=positive_int, default=1, metavar='N',
+                        help='Number of worker processes for the end-to-end runs (default: 1)')
+    parser.add_argument('-b', '--baseline', type=existing_file, default=None, metavar='FILENAME.JSON',
+                        help='Results of an earlier run to compare with (exit status is 1 if there is a regression)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='Relative slowdown compared to the baseline regarded as regression (default: 0.1)')
+    args = parser.parse_args()
+
+    return args
+
+
+def best_time(fun, repeat):
+    """The fastest of the repeated runs is the least disturbed by the other processes of the machine"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fun()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def run_end_to_end(mbox_path, extra_args, workers):
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.run([sys.executable, '-m', 'mboxparser', '-m', str(mbox_path), '-o', os.devnull,
+                        '-w', str(workers), *extra_args], cwd=REPO_DIR, stdout=devnull, check=True,
+                       env={**os.environ, 'PYTHONHASHSEED': '0'})
+
+
+def run_benchmarks(mbox_path, repeat, stages=None, workers=1):
+    """Run the stage and the end-to-end benchmarks and return the results with the description of the environment"""
+    stages = stages or [*STAGES.keys(), *END_TO_END_RUNS.keys()]
+    with open(mbox_path, 'rb') as fh:
+        mbox_hash = blake2b(fh.read(), digest_size=16).hexdigest()
+    corpus = Corpus(mbox_path)
+    num_of_messages = len(corpus.messages)
+
+    results = {}
+    for name in stages:
+        if name in STAGES:
+            fun, kwargs = STAGES[name]
+            seconds = best_time(lambda: fun(corpus, **kwargs), repeat)
+        else:
+            seconds = best_time(lambda: run_end_to_end(mbox_path, END_TO_END_RUNS[name], workers), repeat)
+        results[name] = {'seconds': seconds, 'messages_per_second': num_of_messages / seconds}
+        print(f'{name}: {seconds:.3f}s ({num_of_messages / seconds:.0f} messages/s)', file=sys.stderr)
+
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    return {'commit': commit, 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'mbox_hash': mbox_hash, 'messages': num_of_messages,
+            'mbox_bytes': Path(mbox_path).stat().st_size, 'repeat': repeat, 'workers': workers, 'results': results}
+
+
+def compare(results, baseline, threshold):
+    """Print the relative speed of the stages compared to the baseline and return the names of the regressed ones"""
+    if results['mbox_hash'] != baseline['mbox_hash']:
+        print('WARNING: The baseline was measured on a different MBOX file!', file=sys.stderr)
+    regressions = []
+    for name, result in results['results'].items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None:
+            continue
+        ratio = result['seconds'] / baseline_result['seconds']
+        status = 'REGRESSION' if ratio > 1 + threshold else 'ok'
+        if status != 'ok':
+            regressions.append(name)
+        print(name, f'{baseline_result["seconds"]:.3f}s', f'{result["seconds"]:.3f}s', f'{ratio:.2f}x', status,
+              sep='\t', file=sys.stderr)
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        mbox_path = args.mbox_file
+        if mbox_path is None:
+            # The same seed and number of messages give the same MBOX file (comparable across commits)
+            mbox_path = Path(tmp_dir) / 'benchmark.mbox'
+            generate_mbox(mbox_path, args.messages, args.seed)
+        results = run_benchmarks(mbox_path, args.repeat, args.stages, args.workers)
+
+    if args.output == '-':
+        json_dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.output, 'w', encoding='UTF-8') as fh:
+            json_dump(results, fh, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding='UTF-8') as fh:
+            baseline = json_load(fh)
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print('Regressions:', ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
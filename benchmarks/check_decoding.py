@@ -0,0 +1,71 @@
+import sys
+import random
+from argparse import ArgumentParser
+
+from mboxparser.utils import positive_int
+from mboxparser.decoders import DECODE_BLOCK_SIZE, decode_segments
+from benchmarks.generate_mbox import TEXTS
+
+# The charsets of the generated MBOX files and other (stateful or multibyte) ones seen in real-life archives
+CHARSETS = sorted({charset for _, charsets in TEXTS for charset in charsets} |
+                  {'iso-2022-jp-2', 'iso-2022-kr', 'hz', 'gb2312', 'gb18030', 'big5', 'euc-kr', 'euc-jp', 'cp932',
+                   'utf-16', 'utf-32', 'utf-8-sig', 'utf-7'})
+BLOCK_SIZES = (1, 2, 3, 7, 64, DECODE_BLOCK_SIZE)
+
+
+def parse_args():
+    parser = ArgumentParser(description='Check that decode_segments() without fallback charsets gives the same'
+                                        ' result as bytes.decode() with backslashreplace on corrupted texts')
+    parser.add_argument('-n', '--cases', type=positive_int, default=20000, metavar='N',
+                        help='Number of random cases (default: 20000)')
+    parser.add_argument('-s', '--seed', type=int, default=42,
+                        help='Random seed (default: 42)')
+    args = parser.parse_args()
+
+    return args
+
+
+def corrupted_payload(rng, charset):
+    """Encode random text in the charset and corrupt some bytes (overwritten, deleted or inserted)"""
+    alphabet = ''.join(text for text, _ in TEXTS) + '\n'
+    text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 300)))
+    payload = bytearray(text.encode(charset, errors='ignore'))
+    for _ in range(rng.randint(0, 4)):
+        if len(payload) == 0:
+            break
+        i, r = rng.randrange(len(payload)), rng.random()
+        if r < 0.4:
+            payload[i] = rng.randrange(256)
+        elif r < 0.7:
+            del payload[i]
+        else:
+            payload[i:i] = bytes(rng.randrange(256) for _ in range(rng.randint(1, 3)))
+    return bytes(payload)
+
+
+def check_decoding(num_of_cases, seed):
+    """Return the (charset, block size, payload) triplets of the cases where the results differ"""
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(num_of_cases):
+        charset, block_size = rng.choice(CHARSETS), rng.choice(BLOCK_SIZES)
+        payload = corrupted_payload(rng, charset)
+        expected = payload.decode(charset, errors='backslashreplace')
+        decoded = ''.join(text for _, text in decode_segments(payload, charset, (), block_size))
+        if decoded != expected:
+            failures.append((charset, block_size, payload))
+    return failures
+
+
+def main():
+    args = parse_args()
+    failures = check_decoding(args.cases, args.seed)
+    for charset, block_size, payload in failures:
+        print(charset, block_size, payload, sep='\t', file=sys.stderr)
+    print(f'{len(failures)} of {args.cases} cases differ', file=sys.stderr)
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
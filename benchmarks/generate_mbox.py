@@ -0,0 +1,163 @@
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+from email.header import Header
+from email.utils import format_datetime
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.encoders import encode_base64
+from datetime import datetime, timedelta, timezone
+
+from mboxparser.utils import positive_int
+
+# Text samples in different languages with the charsets they are typically sent in
+TEXTS = [('Árvíztűrő tükörfúrógép. Öt szép szűz lány őrült írót nyúz.',
+          ('utf-8', 'iso-8859-2', 'windows-1250')),
+         ('The quick brown fox jumps over the lazy dog.',
+          ('us-ascii', 'utf-8', 'iso-8859-1')),
+         ('Příliš žluťoučký kůň úpěl ďábelské ódy.',
+          ('utf-8', 'iso-8859-2')),
+         ('Съешь же ещё этих мягких французских булок, да выпей чаю.',
+          ('utf-8', 'koi8-r', 'windows-1251')),
+         ('いろはにほへと ちりぬるを わかよたれそ つねならむ',
+          ('utf-8', 'iso-2022-jp', 'shift_jis')),
+         ('Falsches Üben von Xylophonmusik quält jeden größeren Zwerg.',
+          ('utf-8', 'iso-8859-1', 'windows-1252'))]
+NAMES = [('Kovács Éva', 'iso-8859-2'), ('John Doe', 'us-ascii'), ('Nagy Ödön', 'utf-8'),
+         ('Иван Петров', 'koi8-r'), ('Dvořák Jiří', 'utf-8'), ('山田太郎', 'utf-8'),
+         ('Müller, Jürgen', 'iso-8859-1')]
+DOMAINS = ['example.com', 'example.org', 'levelezo.hu', 'mail.example.net']
+ATTACHMENT_TYPES = [('application', 'pdf', '.pdf'), ('image', 'jpeg', '.jpg'), ('application', 'zip', '.zip'),
+                    ('application', 'vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx')]
+FILENAMES = ['számla', 'report', 'fénykép', 'отчёт', 'déclaration', '写真']
+BROKEN_DATES = ['Mon, 32 Jan 2020 10:11:12 +0100', '2020-01-03 10:11:12', 'Tue, 4 Feb 20 10:11 EST',
+                'Wed, 5 Feb 2020 25:61:00 +0000', 'yesterday', 'Thu, 06 Feb 2020 10:11:12 GMT']
+
+
+def _encoded_word(rng, text, charset):
+    """Encode the text as RFC 2047 encoded-word (Q or B) or keep it as is if it is ASCII"""
+    if text.isascii() and rng.random() < 0.5:
+        return text
+    return Header(text, charset if charset != 'us-ascii' else 'utf-8').encode()
+
+
+def _address(rng):
+    name, charset = rng.choice(NAMES)
+    address = f'user{rng.randint(0, 200)}@{rng.choice(DOMAINS)}'
+    if rng.random() < 0.2:
+        return address
+    return f'"{_encoded_word(rng, name, charset)}" <{address}>'
+
+
+def _date(rng, num):
+    if rng.random() < 0.02:
+        return rng.choice(BROKEN_DATES)
+    tz = timezone(timedelta(minutes=rng.choice([-300, 0, 60, 120, 330])))
+    date = datetime(2010, 1, 1, tzinfo=tz) + timedelta(minutes=num * 37 + rng.randint(0, 30))
+    return format_datetime(date)
+
+
+def _text_part(rng, subtype='plain'):
+    text, charsets = rng.choice(TEXTS)
+    charset = rng.choice(charsets)
+    body = '\n'.join(text for _ in range(rng.randint(1, 40)))
+    if subtype == 'html':
+        body = f'<html><body><p>{body}</p></body></html>'
+    if rng.random() < 0.1:
+        body = f'{body}\nFrom the beginning of a line\n'  # Must be escaped in the MBOX file
+    try:
+        return MIMEText(body, subtype, charset)
+    except UnicodeEncodeError:
+        return MIMEText(body, subtype, 'utf-8')
+
+
+def _attachment(rng, large_attachment_ratio):
+    maintype, subtype, extension = rng.choice(ATTACHMENT_TYPES)
+    size = rng.randint(1000, 64 * 1024)
+    if rng.random() < large_attachment_ratio:
+        size = rng.randint(1024 * 1024, 4 * 1024 * 1024)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(rng.randbytes(size))
+    encode_base64(part)
+    filename = f'{rng.choice(FILENAMES)}_{rng.randint(1, 999)}{extension}'
+    part.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', filename))
+    return part
+
+
+def _body(rng, depth, max_depth, large_attachment_ratio):
+    """Multipart trees of random depth with text parts, alternatives and attachments"""
+    if depth >= max_depth or rng.random() < 0.3:
+        return _text_part(rng, rng.choice(['plain', 'plain', 'html']))
+    subtype = rng.choice(['mixed', 'alternative', 'related'])
+    container = MIMEMultipart(subtype)
+    container.set_boundary(f'=============={rng.getrandbits(64):020d}==')  # The default one is not seeded
+    if subtype == 'alternative':
+        container.attach(_text_part(rng, 'plain'))
+        container.attach(_text_part(rng, 'html'))
+    else:
+        for _ in range(rng.randint(1, 3)):
+            container.attach(_body(rng, depth + 1, max_depth, large_attachment_ratio))
+    if subtype == 'mixed' and rng.random() < 0.5:
+        container.attach(_attachment(rng, large_attachment_ratio))
+    return container
+
+
+def generate_message(rng, num, max_depth=6, large_attachment_ratio=0.01):
+    """Generate one realistic raw message (bytes) with the num-th date and Message-ID"""
+    msg = _body(rng, 0, rng.randint(0, max_depth), large_attachment_ratio)
+    subject_text, subject_charsets = rng.choice(TEXTS)
+    msg['From'] = _address(rng)
+    msg['To'] = ', '.join(_address(rng) for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.3:
+        msg['Cc'] = ', '.join(_address(rng) for _ in range(rng.randint(1, 6)))
+    msg['Subject'] = _encoded_word(rng, subject_text[:rng.randint(10, 60)], rng.choice(subject_charsets))
+    msg['Date'] = _date(rng, num)
+    msg['Message-ID'] = f'<{num}.{rng.getrandbits(64):016x}@{rng.choice(DOMAINS)}>'
+    for hop in range(rng.randint(1, 5)):
+        msg['Received'] = f'from mx{hop}.{rng.choice(DOMAINS)} by mx{hop + 1}.{rng.choice(DOMAINS)}; {_date(rng, num)}'
+    msg['DKIM-Signature'] = f'v=1; a=rsa-sha256; d={rng.choice(DOMAINS)}; b={rng.randbytes(48).hex()}'
+    raw_message = msg.as_bytes()
+    if rng.random() < 0.03:
+        # Raw 8-bit header which is parsed into a Header object (bad header)
+        text, charsets = rng.choice(TEXTS[:1])
+        raw_message = f'X-Raw-Subject: {text[:20]}\n'.encode(rng.choice(charsets)) + raw_message
+    return raw_message
+
+
+def generate_mbox(mbox_path: Path, num_of_messages: int, seed: int = 42, max_depth: int = 6,
+                  large_attachment_ratio: float = 0.01):
+    """Write a reproducible MBOX file (the same seed and parameters give the same bytes)"""
+    rng = random.Random(seed)
+    with open(mbox_path, 'wb') as fh:
+        for num in range(num_of_messages):
+            raw_message = generate_message(rng, num, max_depth, large_attachment_ratio)
+            fh.write(b'From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n')
+            fh.write(raw_message.replace(b'\nFrom ', b'\n>From '))
+            fh.write(b'\n' if raw_message.endswith(b'\n') else b'\n\n')
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', type=Path, required=True, metavar='FILENAME.MBOX',
+                        help='MBOX file to generate')
+    parser.add_argument('-n', '--messages', type=positive_int, default=2000, metavar='N',
+                        help='Number of messages (default: 2000)')
+    parser.add_argument('-s', '--seed', type=int, default=42,
+                        help='Random seed (default: 42)')
+    parser.add_argument('--max_depth', type=int, default=6,
+                        help='Maximal depth of the multipart trees (default: 6)')
+    parser.add_argument('--large_attachment_ratio', type=float, default=0.01,
+                        help='Ratio of the large (1-4 MB) attachments (default: 0.01)')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_args()
+    generate_mbox(args.output, args.messages, args.seed, args.max_depth, args.large_attachment_ratio)
+
+
+if __name__ == '__main__':
+    main()
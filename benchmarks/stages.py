@@ -0,0 +1,110 @@
+from collections import Counter
+
+from mboxparser.stats import Statistics
+from mboxparser.dates import normalize_date
+from mboxparser.openers import MmapMbox
+from mboxparser import payload
+from mboxparser.payload import SNIFF_PREFIX_SIZE, process_payload_r, sniff_content_type
+from mboxparser.processing import ADDRESS_HEADER, process_one_email
+from mboxparser.serializers import SERIALIZERS, get_serializer
+from mboxparser.decoders import decode_addresslike_values, decode_elem, decode_addresslike_values_cached, \
+    decode_elem_cached, set_decode_cache_size
+
+
+class Corpus:
+    """The inputs of the stages extracted once from the MBOX file (outside of the measurements)"""
+
+    def __init__(self, mbox_path):
+        self.mbox_path = mbox_path
+        my_mbox = MmapMbox(mbox_path)
+        self.messages = list(my_mbox.iter_messages())
+        my_mbox.close()
+        self.address_values, self.other_values, self.dates = [], [], []
+        for email_obj in self.messages:
+            for k in {k.lower() for k in email_obj.keys()}:
+                value_list = email_obj.get_all(k, [])
+                if k in ADDRESS_HEADER:
+                    self.address_values.append(value_list)
+                elif k == 'date':
+                    self.dates.extend(value_list)
+                else:
+                    self.other_values.extend(str(val) for val in value_list if '=?' in str(val))
+        self.prefixes = [(part.get_content_type(), part.get_payload(decode=True)[:SNIFF_PREFIX_SIZE])
+                         for email_obj in self.messages for part in email_obj.walk() if not part.is_multipart()]
+        self.final_data = [process_one_email(email_obj, Statistics(), process_payload=True, lenient_dates=True)
+                           for email_obj in self.messages]
+
+
+def open_mbox(corpus):
+    my_mbox = MmapMbox(corpus.mbox_path)
+    len(my_mbox)
+    my_mbox.close()
+
+
+def parse_messages(corpus, headers_only=False):
+    my_mbox = MmapMbox(corpus.mbox_path)
+    for _ in my_mbox.iter_messages(headers_only=headers_only):
+        pass
+    my_mbox.close()
+
+
+def decode_headers(corpus, cached=False):
+    decode_addresslike, decode = decode_addresslike_values, decode_elem
+    if cached:
+        set_decode_cache_size()  # Empty caches
+        decode_addresslike, decode = decode_addresslike_values_cached, decode_elem_cached
+    for value_list in corpus.address_values:
+        decode_addresslike(value_list)
+    for val in corpus.other_values:
+        decode(val)
+
+
+def parse_dates(corpus):
+    for val in corpus.dates:
+        try:
+            normalize_date(val)
+        except ValueError:
+            pass
+
+
+def walk_payload(corpus, sniff_policy='off'):
+    payload._sniff_cache.clear()  # Measure the detections, not the cache
+    type_count = Counter()
+    for email_obj in corpus.messages:
+        process_payload_r(email_obj, type_count, sniff_policy)
+
+
+def sniff(corpus):
+    payload._sniff_cache.clear()
+    for content_type, prefix in corpus.prefixes:
+        sniff_content_type(prefix, content_type)
+
+
+def serialize(corpus, serializer='json'):
+    serialize_fun = get_serializer(serializer)
+    for email_data in corpus.final_data:
+        serialize_fun(email_data)
+
+
+def _available_serializers():
+    available = []
+    for name in SERIALIZERS:
+        try:
+            get_serializer(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+# Stage name -> (function, kwargs)
+STAGES = {'open_mbox': (open_mbox, {}),
+          'parse_messages': (parse_messages, {}),
+          'parse_headers_only': (parse_messages, {'headers_only': True}),
+          'decode_headers': (decode_headers, {}),
+          'decode_headers_cached': (decode_headers, {'cached': True}),
+          'parse_dates': (parse_dates, {}),
+          'walk_payload': (walk_payload, {}),
+          'walk_payload_sniff': (walk_payload, {'sniff_policy': 'always'}),
+          'sniff': (sniff, {}),
+          **{f'serialize_{name}': (serialize, {'serializer': name}) for name in _available_serializers()}}
@@ -4,12 +4,13 @@ from argparse import ArgumentParser
 from json import load as json_load, loads as json_loads
 
 from mboxparser.utils import OpenFileOrSTDStreams, stdin_or_existing_file
+from mboxparser.header_store import is_header_store, iter_header_values
 
 
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument('-i', '--input', type=stdin_or_existing_file, default='-', metavar='FILENAME',
-                        help='JSON file name (default: STDIN)')
+                        help='JSON file or header store (--header_db) name (default: STDIN)')
     parser.add_argument('-o', '--output', type=str, default='-', metavar='FILENAME',
                         help='File to write the output (default: STDOUT)')
     parser.add_argument('-r', '--header', type=str, required=True,
@@ -23,9 +24,9 @@ def remove_newlines(string):
     return re.sub('[ \t]*(\r\n|\r|\n)[ \t]*', ' ', string)
 
 
-def value_freq_pairs(header_values):
-    ret = []
-    for key, freq in sorted(header_values.items(), key=lambda x: (x[1], x[0]), reverse=True):
+def value_freq_pairs(sorted_header_values):
+    """Yield the decoded values with their frequencies (in the order of the input)"""
+    for key, freq in sorted_header_values:
         # Decode JSON in JSON (because JSON does not allow tuple (list) as dictionary key)
         key = json_loads(key)
         new_key = []
@@ -33,22 +34,30 @@ def value_freq_pairs(header_values):
             if isinstance(k, str):  # Only Normal headers may have newlines (address-like ones stored in lists are not)
                 k = remove_newlines(k)
             new_key.append(k)
-        ret.append((new_key, freq))
-
-    return ret
+        yield new_key, freq
 
 
 def grep_header(input_filename, header):
-    # Open and load the JSON from STDIN or from the given file
-    with OpenFileOrSTDStreams(input_filename, encoding='UTF-8') as infile_fh:
-        headers = json_load(infile_fh)
-
-    header_values = headers.get(header)
-    if header_values is None:  # Header check
+    """Yield the values of the header with their frequencies by decreasing frequency
+
+     The header store (--header_db) is read only for the requested header already sorted, the JSON is loaded entirely
+    """
+    if is_header_store(input_filename):
+        sorted_header_values = iter_header_values(input_filename, header)
+    else:
+        # Open and load the JSON from STDIN or from the given file
+        with OpenFileOrSTDStreams(input_filename, encoding='UTF-8') as infile_fh:
+            headers = json_load(infile_fh)
+        header_values = headers.get(header)
+        sorted_header_values = None
+        if header_values is not None:
+            sorted_header_values = sorted(header_values.items(), key=lambda x: (x[1], x[0]), reverse=True)
+
+    if sorted_header_values is None:  # Header check
         print(f'There is no such header ({header})!', file=sys.stderr)
         sys.exit(1)
 
-    return value_freq_pairs(header_values)
+    return value_freq_pairs(sorted_header_values)
 
 
 def main():
@@ -0,0 +1,10 @@
+__all__ = ['iter_emails', 'open_source']
+
+
+def __getattr__(name):
+    # The API (with magic and multiprocessing) is imported only when used,
+    # not by the utility scripts importing only e.g. mboxparser.utils
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,16 +1,32 @@
 import sys
+from os import fsync, truncate
+from time import time, perf_counter
 from pathlib import Path
-from email.header import Header
 from argparse import ArgumentParser
 from pickle import dump as pickle_dump
 from collections import Counter, defaultdict
-from email.utils import parsedate_to_datetime
 from json import dump as json_dump, dumps as json_dumps
 
-from mboxparser.openers import open_mbox
-from mboxparser.payload import process_payload_r
-from mboxparser.utils import OpenFileOrSTDStreams, existing_file
-from mboxparser.decoders import decode_addresslike_values, decode_elem
+from mboxparser.stats import DEFAULT_HEADER_TOP_K, SLOWEST_MESSAGES, Statistics, stats_path_for, load_statistics, \
+    save_statistics
+from mboxparser.parallel import process_shards
+from mboxparser.checkpoint import save_checkpoint, load_checkpoint, remove_checkpoint
+from mboxparser.processing import process_one_email
+from mboxparser.decoders import DEFAULT_DECODE_CACHE_SIZE, decode_cache_info, set_decode_cache_size
+from mboxparser.openers import MultiMbox, find_mboxes, open_mbox
+from mboxparser.payload import SNIFF_POLICIES
+from mboxparser.attachments import AttachmentStore
+from mboxparser.header_store import write_header_store
+from mboxparser.sampling import sample_messages
+from mboxparser.dedup import DEDUP_METHODS, BloomDeduplicator, ExactDeduplicator, find_duplicates, \
+    iter_unique_messages
+from mboxparser.pipeline import ThreadedWriter
+from mboxparser.instrumentation import ProgressReporter, add_time, timed_iter, write_report
+from mboxparser.sqlite_sink import SQLiteSink
+from mboxparser.parquet_sink import PARQUET_COMPRESSIONS, ParquetSink
+from mboxparser.serializers import SERIALIZERS, BufferedRecordWriter, get_serializer
+from mboxparser.utils import COMPRESSED_SUFFIXES, OpenFileOrSTDStreams, existing_file, known_charset, positive_int, \
+    sample_size_or_fraction
 
 
 def parse_args():
@@ -19,20 +35,26 @@ def parse_args():
                                        'Choose if the input is a plain MBOX file or one in a ZIP file')
     group1.add_argument('-m', '--mbox_file', type=Path, default=None, metavar='FILENAME.MBOX',
                         help='Path to the plain MBOX file (if the exitsts the other two arguments are ignored'
-                             ' else this file is written from the other two argument if this argument is supplied)')
+                             ' else this file is written from the other two argument if this argument is supplied,'
+                             ' if omitted the MBOX file is read from the ZIP file as a stream without extracting it)')
     # These two must be specified together if used or the one above must be an existent file!
     group1.add_argument('-i', '--input_zip', type=existing_file, default=None, metavar='FILENAME.ZIP',
                         help='Path to the ZIP file containing the MBOX file')
     # We cannot check this file for existence yet, just convert it to Path object for now
     group1.add_argument('-p', '--mbox_path_in_zip', type=Path, default=None, metavar='PATH/IN/ZIP/TO/FILENAME.MBOX',
                         help='Path to mbox file in ZIP file')
+    group1.add_argument('-B', '--batch', nargs='+', default=None, metavar='GLOB_OR_DIR',
+                        help='Process every MBOX file (also .mbox.gz, .mbox.zst, .mbox.xz) and every .mbox member'
+                             ' of the ZIP files matching the glob patterns or in the directories as one MBOX file'
+                             ' (instead of -m, -i and -p, e.g. all parts of a split Takeout export)')
 
     parser.add_argument('-o', '--output', type=str, metavar='FILENAME', default='-',
-                        help='File to write the output into (default: STDOUT)')
+                        help='File to write the output into'
+                             ' (default: STDOUT, compressed if it ends with .gz, .zst or .xz)')
 
     group2 = parser.add_argument_group('Optional actions', 'Enable or keep disabled the following optional actions')
     group2.add_argument('-v', '--verbose', action='store_true',
-                        help='Write additional info (slows down processing)')
+                        help='Write additional info (slows down processing, see --stats for a faster alternative)')
     group2.add_argument('-k', '--process_payload', action='store_true',
                         help='Process payload together with headers')
     group2.add_argument('-t', '--header_toplist', action='store_true',
@@ -43,115 +65,410 @@ def parse_args():
                         help='Write the pickled bad headers to the output (specified by -o)')
     group2.add_argument('-f', '--final_data', action='store_true',
                         help='Write the final (normalised) data as JSON Lines to the output (specified by -o)')
+    group2.add_argument('--per_part', action='store_true',
+                        help='Write the final data (-f) part by part: a JSON line with the headers ({"id", "headers"})'
+                             ' followed by a line for each payload part ({"id", "part"}), with one worker and without'
+                             ' other sinks the parts are processed one by one while written')
+    group2.add_argument('--serializer', choices=SERIALIZERS, default='json',
+                        help='JSON serializer for the final data: the standard library or the faster orjson or msgspec'
+                             ' if installed (they write compact JSON, default: json)')
     group2.add_argument('-j', '--header_json', type=Path, default=None, metavar='FILENAME.JSON',
                         help='Write the frequencies of header-value pairs to JSON for further examination')
+    group2.add_argument('--header_db', type=Path, default=None, metavar='FILENAME.DB',
+                        help='Write the frequencies of header-value pairs to an indexed SQLite store'
+                             ' (json_header_grep.py reads only the requested header from it)')
     group2.add_argument('-l', '--payload_type_json', type=Path, default=None, metavar='FILENAME.JSON',
                         help='Write the frequencies of payload parts to JSON for further examination')
 
+    group2.add_argument('-q', '--sqlite', type=Path, default=None, metavar='FILENAME.DB',
+                        help='Write the final (normalised) data into SQLite tables (headers, addresses, parts,'
+                             ' attachments) with a full-text index on the parts (use with -k for the payload)')
+
+    group2.add_argument('--parquet', type=Path, default=None, metavar='FILENAME.PARQUET',
+                        help='Write the final (normalised) data into a Parquet file, one row per email'
+                             ' (requires pyarrow, use with -k for the payload)')
+    group2.add_argument('--parquet_row_group_size', type=positive_int, default=100000, metavar='N',
+                        help='Number of emails in a Parquet row group (default: 100000)')
+    group2.add_argument('--parquet_compression', choices=PARQUET_COMPRESSIONS, default='zstd',
+                        help='Compression codec of the Parquet file (default: zstd)')
+
+    group2.add_argument('-x', '--index', action='store_true',
+                        help='Store the offsets of the messages in a sidecar index file next to the MBOX file'
+                             ' to reuse it later (only the appended messages are scanned if the MBOX file grew)')
+    group2.add_argument('-n', '--incremental', action='store_true',
+                        help='Store the statistics next to the MBOX file and only process the messages appended since'
+                             ' the last run updating the stored statistics'
+                             ' (implies -x, -f writes only the new messages)')
+
+    group2.add_argument('--decode_cache_size', type=int, default=DEFAULT_DECODE_CACHE_SIZE, metavar='N',
+                        help='Number of decoded header values to cache (least recently used ones are dropped,'
+                             f' 0 disables caching, default: {DEFAULT_DECODE_CACHE_SIZE})')
+
+    group2.add_argument('--max_exact_header_values', type=positive_int, default=None, metavar='N',
+                        help='Count the values of a header approximately if it has more than N distinct values'
+                             ' to bound the memory usage (e.g. Message-ID, Received, default: always exact)')
+    group2.add_argument('--header_top_k', type=positive_int, default=DEFAULT_HEADER_TOP_K, metavar='K',
+                        help='Number of the most frequent values kept for the approximately counted headers'
+                             f' (default: {DEFAULT_HEADER_TOP_K})')
+
+    group2.add_argument('--dedup', choices=DEDUP_METHODS, default=None,
+                        help='Skip the duplicate messages (e.g. the copies of a message with multiple labels) by their'
+                             ' Message-ID or, if missing, by their normalised content before processing them:'
+                             ' remember every message exactly or in a fixed size Bloom filter for huge MBOX files'
+                             ' (with -w every message is read once more before processing, default: no deduplication)')
+    group2.add_argument('--dedup_capacity', type=positive_int, default=10000000, metavar='N',
+                        help='Expected number of messages for the Bloom filter (default: 10000000)')
+    group2.add_argument('--dedup_fp_rate', type=float, default=1e-6, metavar='RATE',
+                        help='Ratio of unique messages skipped by mistake by the Bloom filter up to its capacity'
+                             ' (default: 1e-6)')
+
+    group2.add_argument('--sample', type=sample_size_or_fraction, default=None, metavar='N|FRACTION',
+                        help='Process only N (or the given fraction of the) randomly chosen messages to estimate'
+                             ' the statistics quickly (plain MBOX files are read only at the chosen messages,'
+                             ' reuse the offsets with -x, the streams are read through, default: all messages)')
+    group2.add_argument('--sample_seed', type=int, default=0,
+                        help='Random seed of the sample (default: 0)')
+
+    group2.add_argument('--lenient_dates', action='store_true',
+                        help='Keep the unparsable date header values as is and count them instead of stopping')
+
+    group2.add_argument('--sniff', choices=SNIFF_POLICIES, default='always',
+                        help='When to detect the content type of the payload parts with libmagic: off (never),'
+                             ' suspicious (only for parts decoded as text with their declared charset to detect'
+                             ' erroneous ones) or always (default: always, the detected type is also needed for -l)')
+
+    group2.add_argument('--fallback_charsets', nargs='+', type=known_charset, default=(), metavar='CHARSET',
+                        help='Decode the undecodable lines of the texts with the first of these charsets which can'
+                             ' decode them (e.g. cp1252 for mixed legacy mailboxes) instead of escaping'
+                             ' the undecodable bytes with backslashes (default: no fallback)')
+
+    group2.add_argument('--max_payload_depth', type=positive_int, default=None, metavar='N',
+                        help='Do not process the parts of multiparts nested deeper than N levels')
+    group2.add_argument('--max_payload_parts', type=positive_int, default=None, metavar='N',
+                        help='Process at most N parts of a message')
+    group2.add_argument('--max_text_size', type=positive_int, default=None, metavar='N',
+                        help='Truncate the text parts of a message above N characters in total')
+
+    group2.add_argument('-a', '--attachment_store', type=Path, default=None, metavar='DIR',
+                        help='Stream the decoded attachments into this content-addressed store (DIR/ab/abcd...)'
+                             ' and add their SHA-256 hash to the final data (identical ones are stored only once)')
+    group2.add_argument('--max_attachment_size', type=positive_int, default=None, metavar='MB',
+                        help='Do not decode (sniff or store) the attachments above this size')
+
+    group3 = parser.add_argument_group('Parallel processing', 'Process shards of the MBOX file in parallel')
+    group3.add_argument('-w', '--workers', type=positive_int, default=1, metavar='N',
+                        help='Number of worker processes (default: 1, no parallel processing)')
+    group3.add_argument('--shard_size', type=positive_int, default=16, metavar='MB',
+                        help='Approximate size of the shards in megabytes (default: 16)')
+    group3.add_argument('--queue_depth', type=int, default=0, metavar='N',
+                        help='Read the input in a background thread and write the output in an other one connected'
+                             ' by queues of N messages (or shards) to overlap I/O and processing, also with one worker'
+                             ' (default: 0, no background threads)')
+    group3.add_argument('--unordered', action='store_true',
+                        help='Write the final data (-f) in the order the shards finish instead of the original order')
+
+    group4 = parser.add_argument_group('Checkpoints', 'Periodically save the state to be able to resume long runs')
+    group4.add_argument('--checkpoint', type=Path, default=None, metavar='DIR',
+                        help='Directory to periodically save the statistics and the position in the MBOX file'
+                             ' and in the output into')
+    group4.add_argument('--checkpoint_interval', type=positive_int, default=300, metavar='SECONDS',
+                        help='Save a checkpoint after this many seconds (default: 300)')
+    group4.add_argument('--resume', action='store_true',
+                        help='Continue from the last checkpoint (if there is any) in the directory given by'
+                             ' --checkpoint producing the same output as an uninterrupted run')
+
+    group5 = parser.add_argument_group('Instrumentation', 'Measure where the time is spent')
+    group5.add_argument('--stats', type=Path, default=None, metavar='FILENAME.JSON',
+                        help='Measure the time of the processing stages, report the throughput periodically to STDERR'
+                             ' and write the time of the stages and the slowest messages to this JSON file')
+    group5.add_argument('--stats_interval', type=positive_int, default=10, metavar='SECONDS',
+                        help='Report the throughput after this many seconds (default: 10)')
+    group5.add_argument('--profile_slowest', type=int, default=0, metavar='N',
+                        help='Process the N slowest messages again with cProfile and add the top functions'
+                             ' to the --stats report (the full profile is written to FILENAME.JSON.prof, needs -m)')
+
     args = parser.parse_args()
 
     # Homebrewed mutual argument groups
-    if (args.mbox_file is None or
-            (not args.mbox_file.is_file() and (args.input_zip is None or args.mbox_path_in_zip is None))):
+    if args.batch is not None and (args.mbox_file is not None or args.input_zip is not None or
+                                   args.mbox_path_in_zip is not None):
+        parser.error('-B/--batch can not be used with -m/--mbox_file, -i/--input_zip or -p/--mbox_path_in_zip !')
+    if (args.batch is None and (args.mbox_file is None or not args.mbox_file.is_file()) and
+            (args.input_zip is None or args.mbox_path_in_zip is None)):
         parser.error('Either -m/--mbox_file must be an existing file'
                      ' or both -i/--input_zip and -p/--mbox_path_in_zip must be specified!')
 
+    if args.mbox_file is None and (args.index or args.incremental):
+        parser.error('-x/--index and -n/--incremental require -m/--mbox_file !')
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume requires --checkpoint !')
+    if args.checkpoint is not None and args.unordered:
+        parser.error('--checkpoint can not be used with --unordered!')
+    if args.checkpoint is not None and args.parquet is not None:
+        parser.error('--checkpoint can not be used with --parquet as Parquet files can not be appended!')
+    if args.checkpoint is not None and args.final_data and Path(args.output).suffix.lower() in COMPRESSED_SUFFIXES:
+        parser.error('--checkpoint with -f/--final_data can not be used with compressed output!')
+    if args.checkpoint is not None and args.final_data and args.output == '-':
+        parser.error('--checkpoint with -f/--final_data requires an output file (-o) to be able to resume!')
+    if args.profile_slowest > 0 and args.stats is None:
+        parser.error('--profile_slowest requires --stats !')
+    if args.profile_slowest > 0 and (args.batch is not None or args.mbox_file is None):
+        parser.error('--profile_slowest requires random access to the messages (-m/--mbox_file) !')
+    if args.sample is not None and (args.workers > 1 or args.checkpoint is not None or args.incremental or
+                                    args.dedup is not None):
+        parser.error('--sample can not be used with -w/--workers, --checkpoint, -n/--incremental or --dedup !')
+    if not 0.0 < args.dedup_fp_rate < 1.0:
+        parser.error('--dedup_fp_rate must be between 0 and 1 !')
+
     # Force processing payload if final data is printed
     args.process_payload |= args.final_data
 
     return args
 
 
-ADDRESS_HEADER = {'to', 'from', 'cc', 'bcc', 'delivered-to', 'reply-to', 'sender'}
-
-
-def handle_bad_header(k, v):
-    # Put quirks here if needed!
-    # Quirks can be classified by header names (we use lowercased header names)
-    _ = k
-    return str(v)
-
-
-def process_one_email(email_obj, headers_dict, header_variants, bad_headers, payload_type_count, process_payload=False,
-                      verbose=False):
-    # I. Metadata
-    # I/1. Collect the frequency of the varitants of each lowercased header key
-    lower_headers = set()
-    for k, value_list in email_obj.items():
-        k_lower = k.lower()
-        header_variants[k_lower][k] += 1  # Global lowercased and actual header key variants
-        lower_headers.add(k_lower)  # The actual lowercased which belong to this email object
-
-    # I/2. Iterate over the lowercased header key variants only
-    header_value_pairs = {}
-    for k in lower_headers:
-        # get_all() retrieves all casing variant of header key k
-        value_list = email_obj.get_all(k, [])
-        # I/2a. Decode address type headers
-        if k in ADDRESS_HEADER:
-            value_list = decode_addresslike_values(value_list)
-        else:
-            new_value_list = []
-            for val in value_list:
-                # I/2b. Collect bad headers for inspection
-                if isinstance(val, Header):
-                    bad_headers.append((k, val))
-                    val = handle_bad_header(k, val)
-                # I/2c. Parse date (and reformat it to ISO timestamp) and decode other encoded header values
-                if k == 'date':
-                    val = val.replace(' -0000', ' +0000')  # Fix timestamp to contain UTC timezone
-                    val = parsedate_to_datetime(val).isoformat()  # Reformat dates to ISO timestamps
-                elif '=?' in val:
-                    val = decode_elem(val)
-                new_value_list.append(val)
-            value_list = tuple(new_value_list)
-
-        header_value_pairs[k] = value_list
-        headers_dict[k][value_list] += 1
-
-    # II. Payload
-    parts = []
-    if process_payload:
-        # II/1. Recursively process payload and extract text parts (plain text, HTML) and attachment names
-        parts = process_payload_r(email_obj, payload_type_count)
-        if verbose:
-            print('Parts len:', len(parts), file=sys.stderr)
-
-    return {'headers': header_value_pairs, 'payload': parts}
-
-
 def main():
     args = parse_args()
-
-    # 1. Open MBOX (mbox_file.is_file() OR (mbox_file is not None or (input_zip AND mbox_path_in_zip)))
-    my_mbox = open_mbox(args.mbox_file, args.input_zip, args.mbox_path_in_zip)
-
-    with OpenFileOrSTDStreams(args.output, 'w', encoding='UTF-8') as out_fh:
+    set_decode_cache_size(args.decode_cache_size)
+
+    # 1. Open MBOX (mbox_file.is_file() OR (mbox_file is not None or (input_zip AND mbox_path_in_zip)) OR batch)
+    if args.batch is not None:
+        members = find_mboxes(args.batch)
+        if len(members) == 0:
+            print('No MBOX files found for', *args.batch, file=sys.stderr)
+            sys.exit(1)
         if args.verbose:
-            # len() is slow to compute on big mbox files!
+            print('MBOX files:', *(name for name, _ in members), sep='\n', file=sys.stderr)
+        my_mbox = MultiMbox(members)
+    else:
+        my_mbox = open_mbox(args.mbox_file, args.input_zip, args.mbox_path_in_zip, args.index or args.incremental)
+
+    # The settings must be the same when resuming from a checkpoint
+    settings = {'mbox_file': str(args.mbox_file), 'input_zip': str(args.input_zip),
+                'mbox_path_in_zip': str(args.mbox_path_in_zip), 'batch': args.batch,
+                'process_payload': args.process_payload,
+                'final_data': args.final_data, 'per_part': args.per_part, 'incremental': args.incremental,
+                'serializer': args.serializer, 'sqlite': str(args.sqlite), 'dedup': args.dedup,
+                'fallback_charsets': list(args.fallback_charsets), 'lenient_dates': args.lenient_dates,
+                'sniff': args.sniff, 'attachment_store': str(args.attachment_store),
+                'max_attachment_size': args.max_attachment_size, 'max_payload_depth': args.max_payload_depth,
+                'max_payload_parts': args.max_payload_parts, 'max_text_size': args.max_text_size}
+    checkpoint = None
+    if args.resume:
+        checkpoint = load_checkpoint(args.checkpoint, settings)
+
+    out_mode = 'w'
+    if checkpoint is not None and args.output != '-':
+        # Drop the output written after the checkpoint and continue from there
+        truncate(args.output, checkpoint['output_pos'])
+        out_mode = 'a'
+
+    with OpenFileOrSTDStreams(args.output, out_mode, encoding='UTF-8') as out_fh:
+        if args.verbose:
+            # len() scans the whole file if there is no index!
             print('Number of entries in mbox:', len(my_mbox), file=sys.stderr)
 
-        # 2. Process each email individually one after another
-        # header_key -> header_value -> header_value_freq
-        headers_dict = defaultdict(Counter)
-        header_variants = defaultdict(Counter)
-        # features_tuple -> features_tuple_freq
-        payload_type_count = Counter()
-        bad_headers = []
-        for idx, email_obj in enumerate(my_mbox, start=1):
+        # 2. Process each email individually one after another or in parallel by shards
+        stats_kwargs = {'max_exact_values': args.max_exact_header_values, 'top_k': args.header_top_k,
+                        'num_of_slowest_messages': max(SLOWEST_MESSAGES, args.profile_slowest)}
+        stats, first_key = Statistics(**stats_kwargs), 0
+        stats_path = stats_path_for(args.mbox_file) if args.incremental else None
+        if checkpoint is not None:
+            # Continue from the checkpoint (the statistics there already contain the stored ones if incremental)
+            stats, first_key = checkpoint['stats'], checkpoint['next_key']
+            if args.verbose:
+                print('Resuming from entry:', first_key + 1, file=sys.stderr)
+        elif args.incremental and stats_path.is_file():
+            # Continue from the stored statistics with the appended messages
+            stats, first_key = load_statistics(stats_path, my_mbox, args.process_payload)
             if args.verbose:
-                print(idx, file=sys.stderr)
-            email_data = process_one_email(email_obj, headers_dict, header_variants, bad_headers, payload_type_count,
-                                           args.process_payload, args.verbose)
+                print('Number of already processed entries:', first_key, file=sys.stderr)
+        stats.num_of_slowest_messages = stats_kwargs['num_of_slowest_messages']  # The stored ones may differ
+
+        deduplicator, duplicates = None, frozenset()
+        if args.dedup is not None:
+            deduplicator = ExactDeduplicator()
+            if args.dedup == 'bloom':
+                deduplicator = BloomDeduplicator(args.dedup_capacity, args.dedup_fp_rate)
+        if deduplicator is not None and args.workers > 1:
+            # The shards need the keys of the duplicates in advance (the messages before first_key are also read
+            # to skip their duplicates after first_key), else the duplicates are skipped while reading the messages
+            duplicates = find_duplicates(my_mbox.iter_raw(0), deduplicator, first_key)
+            if args.verbose:
+                print('Number of duplicates to skip:', len(duplicates), file=sys.stderr)
+
+        sinks = []
+        if args.sqlite is not None:
+            # The rows of the emails after first_key are dropped from an existing database
+            # (when resuming or incremental)
+            sinks.append(SQLiteSink(args.sqlite, first_key))
+        if args.parquet is not None:
+            sinks.append(ParquetSink(args.parquet, args.parquet_row_group_size, args.parquet_compression))
+
+        # The final data is written to the underlying binary file handle in large batches
+        serialize = get_serializer(args.serializer)
+        writer = BufferedRecordWriter(out_fh.buffer)
+
+        timing = args.stats is not None
+        counters_before, run_start = stats.counters.copy(), perf_counter()
+        num_of_messages, num_of_bytes = 0, 0
+        progress = ProgressReporter(args.stats_interval)
+
+        def write_email(email_id, email_data):
+            # 3. Print normalised data as JSON Lines and/or write it to the sinks
+            start = perf_counter() if timing else 0.0
+            if args.final_data and args.per_part:
+                writer.write(serialize({'id': email_id, 'headers': email_data['headers']}))
+                for part in email_data['payload']:  # The parts may be processed here one by one
+                    writer.write(serialize({'id': email_id, 'part': part}))
+            elif args.final_data:
+                writer.write(serialize(email_data))
+            for sink in sinks:
+                sink.write(email_id, email_data)
+            if timing:
+                add_time(stats.counters, 'output', start)
+
+        def checkpoint_if_due(next_key):
+            nonlocal last_checkpoint
+            if args.checkpoint is not None and time() - last_checkpoint >= args.checkpoint_interval:
+                # Flush the output to a consistent point before saving the state belonging to it
+                if output_thread is not None:
+                    output_thread.drain()
+                for sink in sinks:
+                    sink.flush()
+                writer.flush()
+                out_fh.flush()
+                output_pos = 0
+                if args.output != '-':
+                    fsync(out_fh.fileno())
+                    output_pos = out_fh.buffer.tell()
+                save_checkpoint(args.checkpoint, stats, next_key, output_pos, settings)
+                last_checkpoint = time()
+
+        last_checkpoint = time()
+        process_kwargs = {'process_payload': args.process_payload, 'verbose': args.verbose,
+                          'lenient_dates': args.lenient_dates, 'sniff_policy': args.sniff,
+                          'attachment_store': None, 'max_attachment_size': None, 'timing': timing,
+                          'max_payload_depth': args.max_payload_depth, 'max_payload_parts': args.max_payload_parts,
+                          'max_text_size': args.max_text_size, 'fallback_charsets': tuple(args.fallback_charsets),
+                          # The generator of the parts is consumed only when writing the final data part by part,
+                          # and it can not be consumed more than once, sent between processes
+                          # or consumed in the output thread (while updating the statistics),
+                          # and its processing would be timed as output (--stats measures the stages separately)
+                          'lazy_payload': args.final_data and args.per_part and len(sinks) == 0 and
+                          args.workers == 1 and args.queue_depth == 0 and not timing}
+
+        # The output is serialized and written in a background thread if queue_depth is set
+        output_thread, output_fun = None, write_email
+        if args.queue_depth > 0:
+            output_thread = ThreadedWriter(write_email, args.queue_depth)
+            output_fun = output_thread.submit
+        if args.attachment_store is not None:
+            process_kwargs['attachment_store'] = AttachmentStore(args.attachment_store)
+        if args.max_attachment_size is not None:
+            process_kwargs['max_attachment_size'] = args.max_attachment_size * 1024 * 1024
+        if args.workers > 1:
+            for idx, (next_key, shard_stats, shard_data) in enumerate(
+                    process_shards(my_mbox, args.workers, args.shard_size * 1024 * 1024, not args.unordered,
+                                   first_key, args.final_data or len(sinks) > 0, args.decode_cache_size,
+                                   stats_kwargs, duplicates, **process_kwargs), start=1):
+                if args.verbose:
+                    print('Shard', idx, file=sys.stderr)
+                # Merge the statistics of the shards (in order if the shards are ordered)
+                stats.update(shard_stats)
+
+                # The emails of the shard are the ones right before next_key (also if the shards are unordered)
+                for email_id, email_data in enumerate(shard_data, start=next_key - len(shard_data) + 1):
+                    if email_data is not None:  # Skipped duplicate
+                        output_fun(email_id, email_data)
+
+                if timing:
+                    num_of_messages += shard_stats.counters['messages']
+                    num_of_bytes += shard_stats.counters['bytes_read']
+                    progress.update(num_of_messages, num_of_bytes)
+                checkpoint_if_due(next_key)
+        else:
+            # Without payload processing only the headers are parsed
+            headers_only = not args.process_payload
+            if args.sample is not None:
+                # (key, message) pairs of the sample in order
+                messages = sample_messages(my_mbox, args.sample, args.sample_seed, headers_only)
+            elif deduplicator is not None:
+                messages = iter_unique_messages(my_mbox, deduplicator, stats.counters, first_key, headers_only,
+                                                args.queue_depth)
+            else:
+                messages = enumerate(my_mbox.iter_messages(first_key, headers_only, args.queue_depth), start=first_key)
+            if timing:
+                messages = timed_iter(messages, stats.counters)
+            for key, email_obj in messages:
+                idx = key + 1
+                if args.verbose:
+                    print(idx, file=sys.stderr)
+                start = perf_counter() if timing else 0.0
+                email_data = process_one_email(email_obj, stats, **process_kwargs)
+                if timing:
+                    stats.record_message_time(perf_counter() - start, key)
+                output_fun(idx, email_data)
+
+                num_of_messages += 1
+                if timing:
+                    num_of_bytes = my_mbox.bytes_read
+                    progress.update(num_of_messages, num_of_bytes)
+                checkpoint_if_due(idx)  # idx is the key of the next message
+
+            stats.counters.update(decode_cache_info())
+            if timing:
+                stats.counters.update({'messages': num_of_messages, 'bytes_read': num_of_bytes})
+            if args.verbose and args.sample is not None:
+                print('Number of sampled messages:', num_of_messages, file=sys.stderr)
+
+        if output_thread is not None:
+            output_thread.close()
+        start = perf_counter()
+        for sink in sinks:
+            sink.close()
+        writer.flush()
+        if timing:
+            add_time(stats.counters, 'output', start)
+            progress.update(num_of_messages, num_of_bytes, force=True)
 
-            # 3. Print normalised data as JSON Lines
-            if args.final_data:
-                print(json_dumps(email_data, ensure_ascii=False), file=out_fh)
+        if args.verbose:
+            hits, misses = stats.counters['decode_cache_hits'], stats.counters['decode_cache_misses']
+            print('Decode cache hits:', hits, 'misses:', misses,
+                  f'hit rate: {hits / max(hits + misses, 1):.2%}', file=sys.stderr)
+
+            if stats.counters['sniff_calls'] > 0:
+                print('Content type detections:', stats.counters['sniff_calls'],
+                      'cache hits:', stats.counters['sniff_cache_hits'],
+                      f'time: {stats.counters["sniff_seconds"]:.2f}s', file=sys.stderr)
+            if args.attachment_store is not None or args.max_attachment_size is not None:
+                print('Attachments stored:', stats.counters['attachments_stored'],
+                      'deduplicated:', stats.counters['attachments_deduplicated'],
+                      'skipped:', stats.counters['attachments_skipped'], file=sys.stderr)
+            if args.max_payload_depth is not None or args.max_payload_parts is not None or \
+                    args.max_text_size is not None:
+                print('Payload limits reached: depth:', stats.counters['payload_depth_limited'],
+                      'parts:', stats.counters['payload_parts_limited'],
+                      'text size:', stats.counters['payload_text_limited'], file=sys.stderr)
+            if args.dedup is not None:
+                print('Duplicates skipped:', stats.counters['duplicates_skipped'], file=sys.stderr)
+            decoded_chars = {k[len('decoded_chars_'):]: v for k, v in stats.counters.items()
+                             if k.startswith('decoded_chars_')}
+            if len(decoded_chars) > 0:
+                print('Decoded text characters by charset:',
+                      ', '.join(f'{k}: {v}' for k, v in sorted(decoded_chars.items())), file=sys.stderr)
+            sketched_headers = [k for k, v in stats.headers_dict.items() if getattr(v, 'sketched', False)]
+            if len(sketched_headers) > 0:
+                print('Approximately counted headers:', ', '.join(sorted(sketched_headers)), file=sys.stderr)
+            if len(stats.bad_dates) > 0:
+                print('Unparsable dates:', stats.bad_dates.total(), file=sys.stderr)
+
+        if args.incremental:
+            save_statistics(stats_path, stats, my_mbox, args.process_payload)
 
         # 4. Print statistics
         if args.header_toplist:
             # The freqency toplist of the lowercased headers (without their values) at a glance
-            header_count = {key: value.total() for key, value in headers_dict.items()}
+            header_count = {key: value.total() for key, value in stats.headers_dict.items()}
             print('Metadata (lowercased) toplist:', file=out_fh)
             for k, v in sorted(header_count.items(), key=lambda x: (x[1], x[0]), reverse=True):
                 print(f'{k}:', v, file=out_fh)
@@ -159,7 +476,7 @@ def main():
         if args.header_casevariants:
             # The freqency toplist of the header case variants (without their values) at a glance
             print('Metadata (case variants) toplist:', file=out_fh)
-            for k, v in sorted(header_variants.items(), key=lambda x: (x[1].total(), x[0]), reverse=True):
+            for k, v in sorted(stats.header_variants.items(), key=lambda x: (x[1].total(), x[0]), reverse=True):
                 for variant, freq in v.most_common():
                     print(k, variant, freq, sep='\t', file=out_fh)
 
@@ -169,24 +486,39 @@ def main():
         with open(args.header_json, 'w', encoding='UTF-8') as fh:
             # JSON does not allow tuple (list) as dictionary key -> Tuples are converted to JSON
             new_header_dict = defaultdict(Counter)
-            for k, v in headers_dict.items():
+            for k, v in stats.headers_dict.items():
                 for k2, v2 in v.most_common():
                     new_header_dict[k][json_dumps(k2, ensure_ascii=False)] = v2
             json_dump(new_header_dict, fh, ensure_ascii=False, indent=4)
 
+    if args.header_db is not None:
+        # The same data as above indexed by header and frequency
+        write_header_store(args.header_db, stats.headers_dict)
+
     if args.payload_type_json is not None:
         # Payload part features for each part in each email for further analysis
         with open(args.payload_type_json, 'w', encoding='UTF-8') as fh:
             # JSON does not allow tuple (list) as dictionary key -> Tuples are converted to JSON
             new_payload_type_count = {}
-            for k, v in payload_type_count.most_common():
+            for k, v in stats.payload_type_count.most_common():
                 new_payload_type_count[json_dumps(k, ensure_ascii=False)] = v
             json_dump(new_payload_type_count, fh, ensure_ascii=False, indent=4)
 
     if args.bad_headers:
         with OpenFileOrSTDStreams(args.output, 'wb') as out_fh:
             # Dump list of problematic Header classes for manual analysis (also can be used for email parts)
-            pickle_dump(bad_headers, out_fh)
+            pickle_dump(stats.bad_headers, out_fh)
+
+    if args.stats is not None:
+        # The profile is created without writing anything (e.g. into the attachment store)
+        write_report(args.stats, stats, counters_before, perf_counter() - run_start, num_of_messages, num_of_bytes,
+                     my_mbox, args.profile_slowest, not args.process_payload,
+                     **{**process_kwargs, 'verbose': False, 'timing': False, 'attachment_store': None,
+                        'lazy_payload': False})
+
+    if args.checkpoint is not None:
+        # The run is finished, the next one must start over
+        remove_checkpoint(args.checkpoint)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+from .stats import Statistics
+from .parallel import process_shards
+from .sampling import sample_messages
+from .processing import process_one_email
+from .openers import COMPRESSED_MBOX_SUFFIXES, MmapMbox, MultiMbox, StreamMbox, find_mboxes
+
+DEFAULT_SHARD_SIZE = 16 * 1024 * 1024  # bytes
+
+
+def open_source(source):
+    """Open the source as MBOX: a plain MBOX file, or every MBOX file (also compressed) and ZIP member
+     in a directory, a ZIP file, a compressed MBOX file or the files matching a glob pattern (see find_mboxes())
+    """
+    if isinstance(source, (MmapMbox, StreamMbox, MultiMbox)):
+        return source
+    path = Path(source)
+    if path.is_file() and not path.name.lower().endswith(('.zip', *COMPRESSED_MBOX_SUFFIXES)):
+        return MmapMbox(path)
+    members = find_mboxes([str(source)])
+    if len(members) == 0:
+        raise ValueError(f'No MBOX files found for {source} !')
+    return MultiMbox(members)
+
+
+def iter_emails(source, headers=None, payload=False, workers=1, sample=None, seed=None, stats=None,
+                shard_size=DEFAULT_SHARD_SIZE, **process_kwargs):
+    """Yield the (key, email_data) pairs of the messages of the source (see open_source()) in order
+
+     Only the headers listed in headers are decoded (default: all of them) and the payload only if payload is set
+     (email_data has 'payload' only then). The messages are processed by workers processes in parallel shards
+     or, if sample is set, only the sample (the number or the fraction of the messages) is processed (see
+     sample_messages(), seed makes the sample reproducible). The statistics are collected into stats if supplied.
+     The process_kwargs are passed to process_one_email() (e.g. lenient_dates=True).
+    """
+    if sample is not None and workers > 1:
+        raise ValueError('Sampling can not be used with multiple workers!')
+    my_mbox = open_source(source)
+    if headers is not None:
+        headers = frozenset(header.lower() for header in headers)
+    process_kwargs = {**process_kwargs, 'process_payload': payload, 'headers': headers}
+    if stats is None:
+        stats = Statistics()
+
+    try:
+        if workers > 1:
+            for next_key, shard_stats, shard_data in process_shards(my_mbox, workers, shard_size, final_data=True,
+                                                                    **process_kwargs):
+                stats.update(shard_stats)
+                for key, email_data in enumerate(shard_data, start=next_key - len(shard_data)):
+                    if not payload:
+                        del email_data['payload']
+                    yield key, email_data
+        else:
+            headers_only = not payload
+            if sample is not None:
+                messages = sample_messages(my_mbox, sample, seed, headers_only)
+            else:
+                messages = enumerate(my_mbox.iter_messages(0, headers_only))
+            for key, email_obj in messages:
+                email_data = process_one_email(email_obj, stats, **process_kwargs)
+                if not payload:
+                    del email_data['payload']
+                yield key, email_data
+    finally:
+        if my_mbox is not source and isinstance(my_mbox, MmapMbox):
+            my_mbox.close()
@@ -0,0 +1,108 @@
+import re
+from os import replace
+from pathlib import Path
+from hashlib import sha256
+from base64 import b64decode
+from tempfile import NamedTemporaryFile
+from quopri import decodestring as qp_decodestring
+
+CHUNK_SIZE = 1024 * 1024  # characters of the encoded payload
+NON_BASE64_RE = re.compile(rb'[^A-Za-z0-9+/]')
+
+
+def _transfer_encoding(part):
+    return str(part.get('content-transfer-encoding', '')).lower()
+
+
+def _to_bytes(text):
+    """Convert the (encoded) payload to bytes the same way as Message.get_payload() does"""
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        try:
+            return text.encode('ascii', 'surrogateescape')
+        except UnicodeError:
+            return text.encode('raw-unicode-escape')
+
+
+def _encoded_chunks(part, chunk_size):
+    """Yield the encoded payload of the part in chunks of about chunk_size characters cut at line boundaries"""
+    payload = part.get_payload()
+    pos = 0
+    while pos < len(payload):
+        end = payload.find('\n', pos + chunk_size)
+        end = len(payload) if end == -1 else end + 1
+        yield _to_bytes(payload[pos:end])
+        pos = end
+
+
+def iter_decoded_chunks(part, chunk_size=CHUNK_SIZE):
+    """Decode the payload of a non-multipart part chunk by chunk (the whole decoded payload is never in memory)
+
+     For well-formed payloads, the concatenated chunks are the same as part.get_payload(decode=True)
+    """
+    cte = _transfer_encoding(part)
+    if cte == 'base64':
+        # Non-alphabet characters (newlines, padding, garbage) are ignored like b64decode(validate=False) does
+        rest = b''
+        for chunk in _encoded_chunks(part, chunk_size):
+            chunk = rest + NON_BASE64_RE.sub(b'', chunk)
+            cut = len(chunk) - len(chunk) % 4
+            rest = chunk[cut:]
+            yield b64decode(chunk[:cut])
+        if len(rest) > 1:  # A single remaining character can not be decoded
+            yield b64decode(rest + b'=' * (4 - len(rest)))
+    elif cte == 'quoted-printable':
+        # The chunks are cut at line boundaries, so soft line breaks and escapes are never split
+        for chunk in _encoded_chunks(part, chunk_size):
+            yield qp_decodestring(chunk)
+    else:
+        # Plain (7bit, 8bit, binary) payloads need no decoding, uuencoded ones are rare
+        yield part.get_payload(decode=True)
+
+
+def decode_prefix(part, size):
+    """Decode only the first size bytes of the payload of a non-multipart part"""
+    prefix = b''
+    for chunk in iter_decoded_chunks(part, size * 2):  # Base64 and QP need more encoded characters than size
+        prefix += chunk
+        if len(prefix) >= size:
+            break
+    return prefix[:size]
+
+
+def estimated_size(part):
+    """Estimate the decoded size of the payload from the length of the encoded one without decoding it"""
+    encoded_size = len(part.get_payload())
+    if _transfer_encoding(part) == 'base64':
+        return encoded_size * 3 // 4
+    return encoded_size
+
+
+class AttachmentStore:
+    """Content-addressed store of the decoded attachments on disk (the same content is stored only once)"""
+
+    def __init__(self, store_dir: Path):
+        self._store_dir = Path(store_dir)
+        self._store_dir.mkdir(parents=True, exist_ok=True)
+
+    def store(self, part):
+        """Stream the decoded payload of the part into the store and return its SHA-256 hex digest
+         and whether it is a new one
+        """
+        digest = sha256()
+        with NamedTemporaryFile(dir=self._store_dir, suffix='.tmp', delete=False) as tmp_fh:
+            for chunk in iter_decoded_chunks(part):
+                digest.update(chunk)
+                tmp_fh.write(chunk)
+        tmp_path = Path(tmp_fh.name)
+
+        hexdigest = digest.hexdigest()
+        target = self._store_dir / hexdigest[:2] / hexdigest
+        if target.is_file():
+            tmp_path.unlink()  # Duplicate
+            return hexdigest, False
+
+        target.parent.mkdir(exist_ok=True)
+        replace(tmp_path, target)  # Atomic, so parallel workers storing the same content do not collide
+        return hexdigest, True
@@ -0,0 +1,45 @@
+from os import fsync, replace
+from pathlib import Path
+from pickle import dump as pickle_dump, load as pickle_load
+
+CHECKPOINT_FILENAME = 'checkpoint.pickle'
+
+
+def save_checkpoint(checkpoint_dir: Path, stats, next_key: int, output_pos: int, settings: dict):
+    """Atomically replace the checkpoint with the current state
+
+     next_key is the index of the first unprocessed message in the MBOX file (works for streams as well)
+     and output_pos is the length of the (already flushed) output at that point
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = checkpoint_dir / f'{CHECKPOINT_FILENAME}.tmp'
+    with open(tmp_path, 'wb') as fh:
+        pickle_dump({'next_key': next_key, 'output_pos': output_pos, 'settings': settings, 'stats': stats}, fh)
+        fh.flush()
+        fsync(fh.fileno())
+    # Either the old or the new checkpoint is there even if the process is killed at any point
+    replace(tmp_path, checkpoint_dir / CHECKPOINT_FILENAME)
+
+
+def load_checkpoint(checkpoint_dir: Path, settings: dict):
+    """Load the last checkpoint if there is any (else return None)
+
+     Raise ValueError if the checkpoint was created with different settings
+    """
+    checkpoint_path = checkpoint_dir / CHECKPOINT_FILENAME
+    if not checkpoint_path.is_file():
+        return None
+
+    with open(checkpoint_path, 'rb') as fh:
+        checkpoint = pickle_load(fh)
+
+    if checkpoint['settings'] != settings:
+        raise ValueError(f'The checkpoint ({checkpoint_path}) was created with different settings'
+                         f' ({checkpoint["settings"]} != {settings})! Remove it to start over!')
+
+    return checkpoint
+
+
+def remove_checkpoint(checkpoint_dir: Path):
+    """Remove the checkpoint after a successful run"""
+    (checkpoint_dir / CHECKPOINT_FILENAME).unlink(missing_ok=True)
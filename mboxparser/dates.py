@@ -0,0 +1,41 @@
+import re
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+
+# The dominant RFC 2822 layout: [Day, ]DD Mon YYYY HH:MM[:SS] +HHMM[ (comment)]
+# Everything else (2-digit years, named timezones, missing parts, etc.) is left for the standard library
+RFC2822_DATE_RE = re.compile(r'(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), )?([0-9]{1,2}) '
+                             r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) ([1-9][0-9]{3}) '
+                             r'([0-9]{2}):([0-9]{2})(?::([0-9]{2}))? ([+-][0-9]{4})(?: \(.*\))?')
+MONTHS = {month: num for num, month in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+                                                  'Oct', 'Nov', 'Dec'), start=1)}
+_timezone_cache = {}
+
+
+def _get_timezone(tz):
+    """Convert +HHMM to timezone object the same way as email.utils does (cached as there are only a few of them)"""
+    tz_obj = _timezone_cache.get(tz)
+    if tz_obj is None:
+        tzoffset = int(tz)
+        tzsign = -1 if tzoffset < 0 else 1
+        tzoffset = abs(tzoffset)
+        tz_obj = timezone(timedelta(seconds=tzsign * ((tzoffset // 100) * 3600 + (tzoffset % 100) * 60)))
+        _timezone_cache[tz] = tz_obj
+    return tz_obj
+
+
+def normalize_date(val):
+    """Reformat a date header value to ISO timestamp
+
+     The result is identical to parsedate_to_datetime(val).isoformat() (with -0000 treated as UTC),
+     but the common layout is parsed with a precompiled regex. Raise ValueError for invalid dates.
+    """
+    val = val.replace(' -0000', ' +0000')  # Fix timestamp to contain UTC timezone
+    m = RFC2822_DATE_RE.fullmatch(val)
+    if m is not None:
+        dd, mon, yy, thh, tmm, tss, tz = m.groups()
+        return datetime(int(yy), MONTHS[mon], int(dd), int(thh), int(tmm), int(tss or 0),
+                        tzinfo=_get_timezone(tz)).isoformat()
+
+    # Fallback for the odd cases
+    return parsedate_to_datetime(val).isoformat()
@@ -1,6 +1,15 @@
+import codecs
+from collections import Counter
+from functools import lru_cache
 from email.utils import getaddresses
 from email.header import decode_header
 
+DEFAULT_DECODE_CACHE_SIZE = 65536
+DECODE_BLOCK_SIZE = 65536  # bytes
+# The meaning of the bytes depends on the start of the stream (byte order mark or shift state)
+NON_RESUMABLE_CHARSETS = {'utf-16', 'utf-32', 'utf-8-sig', 'utf-7', 'hz', 'iso2022_jp', 'iso2022_jp_1',
+                          'iso2022_jp_2', 'iso2022_jp_2004', 'iso2022_jp_3', 'iso2022_jp_ext', 'iso2022_kr'}
+
 
 def decode_addresslike_values(values):
     name_address_pairs = []
@@ -37,12 +46,119 @@ def decode_elem(elem):
     return elem_part_joined
 
 
-def decode_with_fallback(payload, content_charset):
-    try:
-        msg = payload.decode(content_charset)
-    except UnicodeDecodeError:
-        # Decode with replacements. The text is mostly OK, with some broken part at the end or beyond repair
-        # Empirically charted makes it all worse.
-        # Idea: The string should be split at the first error and for the second part different encoding should be tried
-        msg = payload.decode(content_charset, errors='backslashreplace')
-    return msg
+@lru_cache(maxsize=None)
+def lookup_charset(charset):
+    """The codec of the charset (resolving the aliases, e.g. latin1, ISO_8859-1 -> iso8859-1) cached by the raw name"""
+    return codecs.lookup(charset)
+
+
+def _backslashreplace(bad_bytes):
+    return ''.join(f'\\x{byte:02x}' for byte in bad_bytes)
+
+
+def decode_segments(payload, content_charset, fallback_charsets=(), block_size=DECODE_BLOCK_SIZE):
+    """Decode the payload with the incremental decoder of its charset in one pass and yield (charset, text) segments
+
+     At an undecodable byte sequence the rest of the line is decoded with the first of the fallback charsets
+     which can decode it, else the undecodable bytes are backslash-escaped (charset: 'backslashreplace').
+     Then decoding continues with the declared charset after them. Only the part of the current block before
+     the error is decoded twice. The charsets with stream state (NON_RESUMABLE_CHARSETS) are decoded at once
+     with backslash-escaping as decoding can not be resumed in the middle of them.
+    """
+    codec = lookup_charset(content_charset)
+    fallback_codecs = [lookup_charset(charset) for charset in fallback_charsets]
+    fallback_codecs = [fallback for fallback in fallback_codecs if fallback.name != codec.name]
+    if codec.name in NON_RESUMABLE_CHARSETS:
+        yield codec.name, payload.decode(codec.name, errors='backslashreplace')
+        return
+    decoder = codec.incrementaldecoder('strict')
+    payload = memoryview(payload)
+    pos = 0
+    while True:
+        block = payload[pos:pos + block_size]
+        final = pos + block_size >= len(payload)
+        state = decoder.getstate()
+        # The bytes buffered from the previous block (e.g. an incomplete multibyte character) are decoded first
+        base = pos - len(state[0])
+        try:
+            text = decoder.decode(block, final)
+        except UnicodeDecodeError as e:
+            error_start, error_end = base + e.start, base + e.end
+            # 1. Decode the text before the error again without the error
+            decoder.setstate(state)
+            if error_start > pos:
+                yield codec.name, decoder.decode(payload[pos:error_start])
+            decoder.reset()
+            # 2. Try the fallback charsets until the end of the line
+            block_end = min(pos + block_size, len(payload))
+            line_end = bytes(payload[error_start:block_end]).find(b'\n')
+            segment_end = block_end if line_end == -1 else error_start + line_end + 1
+            for fallback in fallback_codecs:
+                try:
+                    text = fallback.decode(payload[error_start:segment_end])[0]
+                except UnicodeDecodeError:
+                    continue
+                yield fallback.name, text
+                pos = segment_end
+                break
+            else:
+                # 3. Escape the undecodable bytes as the 'backslashreplace' error handler would do
+                yield 'backslashreplace', _backslashreplace(payload[error_start:error_end])
+                pos = error_end
+            if pos >= len(payload):
+                break
+            continue
+        except UnicodeError:
+            # The incremental decoder gave up (e.g. pending buffer overflow): decode the rest without it
+            yield codec.name, bytes(payload[base:]).decode(codec.name, errors='backslashreplace')
+            break
+        if len(text) > 0:
+            yield codec.name, text
+        pos += len(block)
+        if final:
+            break
+
+
+def decode_with_fallback(payload, content_charset, fallback_charsets=(), counters=None):
+    """Decode the payload in one pass resuming at the errors with the fallback charsets (see decode_segments())
+
+     Without fallback charsets the result is the same as payload.decode(content_charset, errors='backslashreplace').
+     The number of characters decoded by each charset is counted in counters (decoded_chars_CHARSET).
+    """
+    segments = list(decode_segments(payload, content_charset, fallback_charsets))
+    if counters is not None:
+        for charset, text in segments:
+            counters[f'decoded_chars_{charset}'] += len(text)
+    return ''.join(text for _, text in segments)
+
+
+def set_decode_cache_size(maxsize=DEFAULT_DECODE_CACHE_SIZE):
+    """(Re)create the LRU caches of the decoded header values (0 disables caching, None means unbounded)"""
+    global _decode_elem_lru, _decode_addresslike_values_lru
+    _decode_elem_lru = lru_cache(maxsize)(decode_elem)
+    _decode_addresslike_values_lru = lru_cache(maxsize)(decode_addresslike_values)
+
+
+_decode_elem_lru, _decode_addresslike_values_lru = None, None
+set_decode_cache_size()
+
+
+def decode_elem_cached(elem):
+    """The same as decode_elem(), but the results are cached by the raw header value"""
+    if isinstance(elem, str):
+        return _decode_elem_lru(elem)
+    return decode_elem(elem)  # Unhashable (e.g. Header objects)
+
+
+def decode_addresslike_values_cached(values):
+    """The same as decode_addresslike_values(), but the results are cached by the raw header values"""
+    if all(isinstance(value, str) for value in values):
+        return _decode_addresslike_values_lru(tuple(values))
+    return decode_addresslike_values(values)  # Unhashable (e.g. Header objects)
+
+
+def decode_cache_info():
+    """The number of cache hits and misses of the cached decoders so far"""
+    elem_info, addresslike_info = _decode_elem_lru.cache_info(), _decode_addresslike_values_lru.cache_info()
+    return Counter({'decode_cache_hits': elem_info.hits + addresslike_info.hits,
+                    'decode_cache_misses': elem_info.misses + addresslike_info.misses})
@@ -0,0 +1,120 @@
+import re
+from math import ceil, log
+from hashlib import blake2b
+
+from .pipeline import threaded_iter
+from .openers import header_end, parse_message
+
+DEDUP_METHODS = ('exact', 'bloom')
+DIGEST_SIZE = 16  # bytes
+MESSAGE_ID_RE = re.compile(rb'^message-id:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)', re.IGNORECASE | re.MULTILINE)
+# Headers which differ between the copies of the same message (e.g. the labels in a Takeout export)
+VOLATILE_HEADERS = (b'x-gmail-labels:', b'x-gm-thrid:', b'status:', b'x-status:', b'x-keywords:', b'x-uid:',
+                    b'x-mozilla-status:', b'x-mozilla-status2:')
+
+
+def message_digest(raw_message: bytes):
+    """Hash the Message-ID of the raw message or (if it has none) its normalised content
+
+     The normalised content is the message without the From line and the volatile headers
+     with the line endings and the trailing whitespace normalised
+    """
+    end = header_end(raw_message, 0, len(raw_message))
+    m = MESSAGE_ID_RE.search(raw_message, 0, end)
+    if m is not None:
+        message_id = b' '.join(m.group(1).split())  # Unfold and normalise whitespace
+        if len(message_id) > 0:
+            return blake2b(b'message-id:' + message_id, digest_size=DIGEST_SIZE).digest()
+
+    digest = blake2b(b'content:', digest_size=DIGEST_SIZE)
+    in_headers, skip_continuation = True, False
+    for line in raw_message.split(b'\n')[1:]:  # The From line contains the date of the copy
+        line = line.rstrip()
+        if in_headers:
+            if len(line) == 0:
+                in_headers = False
+            elif line[:1] in b' \t':  # Continuation line of the previous header
+                if skip_continuation:
+                    continue
+            else:
+                skip_continuation = line.lower().startswith(VOLATILE_HEADERS)
+                if skip_continuation:
+                    continue
+        digest.update(line)
+        digest.update(b'\n')
+    return digest.digest()
+
+
+class ExactDeduplicator:
+    """Remember the digest of every message (exact, but the memory grows with the number of messages)"""
+
+    def __init__(self):
+        self._seen = set()
+
+    def seen(self, digest: bytes):
+        """Return True if the digest was seen before, else remember it"""
+        if digest in self._seen:
+            return True
+        self._seen.add(digest)
+        return False
+
+
+class BloomDeduplicator:
+    """Remember the digests of the messages in a Bloom filter of fixed size
+
+     Up to capacity messages, at most fp_rate ratio of the unique messages are regarded as duplicates
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self._num_of_bits = ceil(-capacity * log(fp_rate) / log(2) ** 2)
+        self._num_of_hashes = max(1, round(self._num_of_bits / capacity * log(2)))
+        self._bits = bytearray((self._num_of_bits + 7) // 8)
+
+    def seen(self, digest: bytes):
+        """Return True if the digest was (probably) seen before, else remember it"""
+        # The positions are derived from the two halves of the digest (double hashing)
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        found = True
+        for i in range(self._num_of_hashes):
+            pos = (h1 + i * h2) % self._num_of_bits
+            byte_pos, mask = pos >> 3, 1 << (pos & 7)
+            if not self._bits[byte_pos] & mask:
+                found = False
+                self._bits[byte_pos] |= mask
+        return found
+
+
+def iter_unique_messages(my_mbox, deduplicator, counters, first_key: int = 0, headers_only: bool = False,
+                         queue_depth: int = 0):
+    """Yield the (key, message) pairs of the messages from the first_key-th one skipping the duplicates
+     before parsing them (their number is counted in counters)
+
+     The messages before first_key are also read to skip their duplicates after first_key.
+     The whole raw messages are read as the content of the ones without Message-ID is hashed.
+     If queue_depth is positive, the messages are read in a background thread (see MmapMbox.iter_messages())
+    """
+    raw_messages = my_mbox.iter_raw(0)
+    if queue_depth > 0:
+        raw_messages = threaded_iter(raw_messages, queue_depth)
+    for key, raw_message in enumerate(raw_messages):
+        is_duplicate = deduplicator.seen(message_digest(raw_message))
+        if key < first_key:
+            continue
+        if is_duplicate:
+            counters['duplicates_skipped'] += 1
+            continue
+        my_mbox.bytes_read += len(raw_message)
+        yield key, parse_message(raw_message, headers_only)
+
+
+def find_duplicates(raw_messages, deduplicator, first_key: int = 0):
+    """Return the keys of the duplicate raw messages from the first_key-th message
+     (for the parallel processing where the shards need the keys in advance)
+
+     Every message is read (also the ones before first_key) to find the duplicates of the earlier messages
+    """
+    duplicates = set()
+    for key, raw_message in enumerate(raw_messages):
+        if deduplicator.seen(message_digest(raw_message)) and key >= first_key:
+            duplicates.add(key)
+    return duplicates
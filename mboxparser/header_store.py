@@ -0,0 +1,51 @@
+import sqlite3
+from pathlib import Path
+from json import dumps as json_dumps
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def is_header_store(path):
+    """Check if the file is an SQLite database (header store) instead of a JSON dump"""
+    if path == '-':
+        return False  # STDIN can only be JSON
+    with open(path, 'rb') as fh:
+        return fh.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def write_header_store(db_path: Path, headers_dict):
+    """Write the frequencies of the header-value pairs into an SQLite table indexed by header and frequency
+
+     The values are stored as JSON (the same way as the keys of the -j JSON dump)
+    """
+    Path(db_path).unlink(missing_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('CREATE TABLE header_values (header TEXT NOT NULL, value TEXT NOT NULL, freq INTEGER NOT NULL)')
+    conn.executemany('INSERT INTO header_values VALUES (?, ?, ?)',
+                     ((k, json_dumps(value, ensure_ascii=False), freq)
+                      for k, v in headers_dict.items() for value, freq in v.items()))
+    # The values of a header are read in the order of the index without sorting
+    conn.execute('CREATE INDEX header_values_order ON header_values (header, freq DESC, value DESC)')
+    conn.commit()
+    conn.close()
+
+
+def iter_header_values(db_path: Path, header):
+    """Return an iterator of the (JSON encoded value, frequency) pairs of the header by decreasing frequency
+
+     Return None if there is no such header
+    """
+    conn = sqlite3.connect(f'{Path(db_path).resolve().as_uri()}?mode=ro', uri=True)
+    if conn.execute('SELECT 1 FROM header_values WHERE header = ? LIMIT 1', (header,)).fetchone() is None:
+        conn.close()
+        return None
+
+    def iter_rows():
+        try:
+            yield from conn.execute('SELECT value, freq FROM header_values WHERE header = ?'
+                                    ' ORDER BY freq DESC, value DESC', (header,))
+        finally:
+            conn.close()
+
+    return iter_rows()
@@ -0,0 +1,112 @@
+import sys
+import pstats
+from io import StringIO
+from json import dump as json_dump
+from cProfile import Profile
+from time import perf_counter
+
+from .stats import Statistics
+from .processing import process_one_email
+
+# Counter prefix -> description of the stages (the times and calls are stored in Statistics.counters
+# as {prefix}_seconds and {prefix}_calls, so they are merged from the workers like the other counters)
+STAGES = {'iteration': 'Mailbox iteration (splitting and parsing)',
+          'header_decoding': 'Header decoding',
+          'date_parsing': 'Date parsing',
+          'payload': 'Payload recursion',
+          'sniff': 'libmagic',
+          'output': 'Output writing'}
+PROFILE_TOP_FUNCTIONS = 20
+
+
+def add_time(counters, stage, start):
+    """Add the time elapsed since start (perf_counter()) to the stage"""
+    counters[f'{stage}_seconds'] += perf_counter() - start
+    counters[f'{stage}_calls'] += 1
+
+
+def timed_iter(iterable, counters, stage='iteration'):
+    """Yield the elements of the iterable adding the time of producing each of them to the stage"""
+    it = iter(iterable)
+    while True:
+        start = perf_counter()
+        try:
+            elem = next(it)
+        except StopIteration:
+            return
+        add_time(counters, stage, start)
+        yield elem
+
+
+class ProgressReporter:
+    """Print the throughput (messages/s, bytes/s) to STDERR at most once in every interval seconds"""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._start = perf_counter()
+        self._last_report = self._start
+
+    def update(self, num_of_messages, num_of_bytes, force=False):
+        now = perf_counter()
+        if force or now - self._last_report >= self._interval:
+            elapsed = max(now - self._start, 1e-9)
+            print(f'Processed {num_of_messages} messages in {elapsed:.1f}s',
+                  f'({num_of_messages / elapsed:.1f} messages/s, {num_of_bytes / elapsed / 1024 / 1024:.2f} MB/s)',
+                  file=sys.stderr)
+            self._last_report = now
+
+
+def stage_report(counters, elapsed):
+    """The cumulative time and number of calls of each stage (summed over the workers if in parallel)"""
+    report = {}
+    for stage, description in STAGES.items():
+        seconds = counters[f'{stage}_seconds']
+        report[stage] = {'description': description, 'seconds': seconds, 'calls': counters[f'{stage}_calls'],
+                         'share_of_wall_time': seconds / max(elapsed, 1e-9)}
+    return report
+
+
+def profile_messages(my_mbox, keys, profile_path, headers_only=False, **process_kwargs):
+    """Process the messages again with cProfile and return the top functions by cumulative time
+
+     The full profile is dumped to profile_path (to be examined e.g. with pstats or snakeviz)
+    """
+    profiler = Profile()
+    for key in keys:
+        email_obj = my_mbox.get_message(key, headers_only)
+        profiler.runcall(process_one_email, email_obj, Statistics(), **process_kwargs)
+    profiler.dump_stats(profile_path)
+
+    profile_stats = pstats.Stats(profiler, stream=StringIO()).sort_stats('cumulative')
+    top_functions = []
+    for func in profile_stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+        _, num_of_calls, total_time, cumulative_time, _ = profile_stats.stats[func]
+        top_functions.append({'function': pstats.func_std_string(func), 'calls': num_of_calls,
+                              'total_seconds': total_time, 'cumulative_seconds': cumulative_time})
+    return top_functions
+
+
+def write_report(report_path, stats, counters_before, elapsed, num_of_messages, num_of_bytes, my_mbox=None,
+                 profile_slowest=0, headers_only=False, **process_kwargs):
+    """Write the JSON report of the run: throughput, time of the stages and the slowest messages
+
+     The profile_slowest slowest messages are processed again with cProfile if the MBOX supports random access
+    """
+    counters = stats.counters - counters_before  # Only this run (the counters may be continued from earlier runs)
+    slowest_messages = [{'key': key, 'seconds': seconds} for seconds, key in sorted(stats.slowest_messages,
+                                                                                     reverse=True)]
+    report = {'wall_seconds': elapsed, 'messages': num_of_messages, 'bytes': num_of_bytes,
+              'messages_per_second': num_of_messages / max(elapsed, 1e-9),
+              'bytes_per_second': num_of_bytes / max(elapsed, 1e-9),
+              'duplicates_skipped': counters['duplicates_skipped'], 'stages': stage_report(counters, elapsed),
+              'slowest_messages': slowest_messages}
+
+    if profile_slowest > 0 and hasattr(my_mbox, 'get_message'):
+        keys = [message['key'] for message in slowest_messages[:profile_slowest]]
+        profile_path = f'{report_path}.prof'
+        report['profile'] = {'path': profile_path, 'keys': keys,
+                             'top_functions': profile_messages(my_mbox, keys, profile_path, headers_only,
+                                                               **process_kwargs)}
+
+    with open(report_path, 'w', encoding='UTF-8') as fh:
+        json_dump(report, fh, ensure_ascii=False, indent=4)
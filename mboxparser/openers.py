@@ -1,58 +1,480 @@
-import builtins
-from mailbox import mbox
+import sys
+from os import fstat
+from array import array
+from mailbox import linesep
 from pathlib import Path
+from hashlib import blake2b
 from zipfile import ZipFile
+from shutil import copyfileobj
+from glob import glob
+from functools import partial
+from email.parser import Parser, HeaderParser
+from mmap import mmap, ACCESS_READ
+from contextlib import contextmanager
+from pickle import dump as pickle_dump, load as pickle_load
 
+from .pipeline import threaded_iter
+from .utils import COMPRESSED_SUFFIXES, open_compressed
 
-def _mbox_w_fake_open(fh):
-    """Hack to be able to open a mailbox from file-handle"""
-    # 1. Save open()
-    original_open = builtins.open
+COMPRESSED_MBOX_SUFFIXES = tuple(f'.mbox{suffix}' for suffix in COMPRESSED_SUFFIXES)
+SEPARATOR = b'From '
+LINE_SEPARATOR = b'\n' + SEPARATOR
+INDEX_VERSION = 1
+HASH_SIZE = 8  # bytes
+CHUNK_SIZE = 16 * 1024 * 1024  # bytes
 
-    # 2. Define fake open() to intercept the call
-    def fake_open(*_):
-        return fh
 
-    # 3. Set the fake open()
-    builtins.open = fake_open
+def index_path_for(mbox_path: Path):
+    """The sidecar index file is stored next to the MBOX file"""
+    return mbox_path.with_name(f'{mbox_path.name}.idx')
 
-    # 4. Open the mailbox with fake open()
-    opened_mbox = mbox('FAKE PATH')
 
-    # 5. Restore open()
-    builtins.open = original_open
+def _previous_line_is_empty(buf, pos):
+    """Check whether the line ending right before pos is an empty line (mailbox.mbox compatible)"""
+    line_start = pos - len(linesep)
+    return (line_start >= 0 and buf[line_start:pos] == linesep and
+            (line_start == 0 or buf[line_start - 1] == 10))  # 10 == ord('\n')
 
-    # 6. Return the opened mbox
-    return opened_mbox
 
+def header_end(buf, start, stop):
+    """Return the end of the header block of the message in buf[start:stop] (before the first empty line)
 
-def _mbox_from_zip_file(inp_zip_path: Path, mbox_path_in_zip: Path, out_mbox_path: Path = None):
-    """Opens (and optionally extracts) an MBOX file in ZIP files e.g. Google Takeout archives"""
+     The parser would stop at the same line, so parsing only buf[start:header_end] yields the same headers
+    """
+    end = stop
+    # An empty line is a newline (\n, \r\n or \r) right after an other newline (\n or \r)
+    for empty_line in (b'\n\n', b'\n\r', b'\r\r'):
+        pos = buf.find(empty_line, start, end)
+        if pos != -1:
+            end = pos + 1  # Keep the newline of the last header line
+    return end
+
+
+def parse_message(raw_message, headers_only: bool = False):
+    """Parse the bytes-like raw message (From line is the unixfrom) to email.message.Message
+
+     If headers_only is set, only the headers are parsed (the body is neither decoded nor parsed)
+    """
+    if headers_only:
+        raw_message = raw_message[:header_end(raw_message, 0, len(raw_message))]
+    # The same as BytesParser().parsebytes(), but without copying the bytes before decoding
+    text = str(raw_message, 'ASCII', 'surrogateescape')
+    if linesep != b'\n':
+        text = text.replace(linesep.decode('ASCII'), '\n')
+    return HeaderParser().parsestr(text) if headers_only else Parser().parsestr(text)
+
+
+class MmapMbox:
+    """Read-only MBOX reader which memory-maps the file and splits it at the "From " lines like mailbox.mbox does"""
+
+    def __init__(self, mbox_path: Path, start: int = 0, end: int = None, use_index: bool = False):
+        """Optionally only the messages in the [start, end) byte range are read (start must be a message boundary)
+
+         If use_index is set, the offsets of the messages are read from (and stored in) a sidecar index file
+         which is updated by scanning only the appended messages if the MBOX file grew since the last time
+        """
+        self._path = Path(mbox_path)
+        self._fh = open(self._path, 'rb')
+        self._stat = fstat(self._fh.fileno())
+        self._size = self._stat.st_size
+        if self._size > 0:
+            self._mm = mmap(self._fh.fileno(), 0, access=ACCESS_READ)
+        else:
+            self._mm = b''  # Empty files can not be memory-mapped
+        self._start = start
+        self._end = self._size if end is None else end
+        self._use_index = use_index and start == 0 and end is None  # Index is only used for the whole file
+        self._starts, self._stops, self._hashes = None, None, None
+        self.bytes_read = 0  # The number of bytes parsed by get_message() (for throughput reporting)
+
+    def _scan(self, pos, end):
+        """Find the (start, stop) offsets of the messages with a byte scan instead of reading line-by-line"""
+        mm = self._mm
+        starts, stops = array('Q'), array('Q')
+        # 1. The first message starts at the beginning of the range or at the first separator line
+        if mm[pos:pos + len(SEPARATOR)] != SEPARATOR:
+            pos = mm.find(LINE_SEPARATOR, pos, end)
+            if pos != -1:
+                pos += 1  # Skip the newline before the separator
+        # 2. Each message ends where the next one starts (without the empty line before it) or at the end of the range
+        while pos != -1:
+            starts.append(pos)
+            next_pos = mm.find(LINE_SEPARATOR, pos, end)
+            if next_pos != -1:
+                next_pos += 1
+                stop = next_pos
+            else:
+                stop = end
+            if _previous_line_is_empty(mm, stop):
+                stop -= len(linesep)
+            stops.append(stop)
+            pos = next_pos
+
+        return starts, stops
+
+    def _hash_messages(self, starts, stops):
+        """Content hash of each message concatenated to one bytes object"""
+        hashes = bytearray()
+        with memoryview(self._mm) as mm_view:
+            for start, stop in zip(starts, stops):
+                hashes += blake2b(mm_view[start:stop], digest_size=HASH_SIZE).digest()
+        return bytes(hashes)
+
+    def _generate_toc(self):
+        if not self._use_index:
+            self._starts, self._stops = self._scan(self._start, self._end)
+            return
+
+        index_path = index_path_for(self._path)
+        index = None
+        if index_path.is_file():
+            with open(index_path, 'rb') as fh:
+                index = pickle_load(fh)
+            if index.get('version') != INDEX_VERSION:
+                index = None
+
+        if index is not None and index['size'] == self._size and index['mtime_ns'] == self._stat.st_mtime_ns:
+            # a) The MBOX file is unchanged -> Use the index as is
+            self._starts, self._stops, self._hashes = index['starts'], index['stops'], index['hashes']
+            return
+
+        starts = None
+        if index is not None and 0 < len(index['starts']) and index['size'] < self._size:
+            # b) The MBOX file grew -> If the first and the last indexed messages are unchanged,
+            #    messages were only appended: rescan from the last indexed message only
+            old_starts, old_stops, old_hashes = index['starts'], index['stops'], index['hashes']
+            tail_starts, tail_stops = self._scan(old_starts[-1], self._size)
+            tail_hashes = self._hash_messages(tail_starts, tail_stops)
+            if (len(tail_starts) > 0 and tail_starts[0] == old_starts[-1] and
+                    tail_hashes[:HASH_SIZE] == old_hashes[-HASH_SIZE:] and
+                    self._hash_messages(old_starts[:1], old_stops[:1]) == old_hashes[:HASH_SIZE]):
+                starts, stops = old_starts[:-1] + tail_starts, old_stops[:-1] + tail_stops
+                hashes = old_hashes[:-HASH_SIZE] + tail_hashes
+
+        if starts is None:
+            # c) No (usable) index -> Scan the whole file
+            starts, stops = self._scan(0, self._size)
+            hashes = self._hash_messages(starts, stops)
+
+        self._starts, self._stops, self._hashes = starts, stops, hashes
+        try:
+            with open(index_path, 'wb') as fh:
+                pickle_dump({'version': INDEX_VERSION, 'size': self._size, 'mtime_ns': self._stat.st_mtime_ns,
+                             'starts': starts, 'stops': stops, 'hashes': hashes}, fh)
+        except OSError as e:
+            print(f'Could not write the index file ({index_path}): {e}', file=sys.stderr)
+
+    def __len__(self):
+        if self._starts is None:
+            self._generate_toc()
+        return len(self._starts)
+
+    def __iter__(self):
+        return self.iter_messages()
+
+    def iter_raw(self, first_key: int = 0, headers_only: bool = False):
+        """Yield the raw messages (including the From line) as bytes starting from the first_key-th message
+
+         If headers_only is set, only the header block of the messages is yielded
+        """
+        for key in range(first_key, len(self)):
+            start, stop = self._starts[key], self._stops[key]
+            if headers_only:
+                stop = header_end(self._mm, start, stop)
+            yield self._mm[start:stop]
+
+    def iter_messages(self, first_key: int = 0, headers_only: bool = False, queue_depth: int = 0):
+        """Iterate over the messages starting from the first_key-th message (optionally parsing only the headers)
+
+         If queue_depth is positive, the messages are read from the file in a background thread
+        """
+        if queue_depth > 0:
+            for raw_message in threaded_iter(self.iter_raw(first_key, headers_only), queue_depth):
+                self.bytes_read += len(raw_message)
+                yield parse_message(raw_message, headers_only)
+        else:
+            for key in range(first_key, len(self)):
+                yield self.get_message(key, headers_only)
+
+    def message_hash(self, key):
+        """Return the content hash of the message (only available if the index is used)"""
+        if self._starts is None:
+            self._generate_toc()
+        return self._hashes[key * HASH_SIZE:(key + 1) * HASH_SIZE]
+
+    def get_bytes(self, key):
+        """Return the raw bytes of the message including the From line"""
+        if self._starts is None:
+            self._generate_toc()
+        return self._mm[self._starts[key]:self._stops[key]]
+
+    def get_message(self, key, headers_only: bool = False):
+        """Return an email.message.Message parsed directly from the memory-mapped file (From line is the unixfrom)
+
+         If headers_only is set, the body is not even read from the file
+        """
+        if self._starts is None:
+            self._generate_toc()
+        start, stop = self._starts[key], self._stops[key]
+        if headers_only:
+            stop = header_end(self._mm, start, stop)
+        self.bytes_read += stop - start
+        with memoryview(self._mm)[start:stop] as message_view:
+            return parse_message(message_view)
+
+    def shards(self, shard_size: int, first_key: int = 0, headers_only: bool = False):
+        """Split the messages into (path, start, end) byte ranges of about shard_size bytes on message boundaries
+
+         Yield (key of the first message after the shard, byte range) pairs
+         (headers_only is ignored as the workers read the byte ranges themselves)
+        """
+        _ = headers_only
+        if self._starts is None:
+            self._generate_toc()
+        shard_start = None
+        for key, start in enumerate(self._starts[first_key:], start=first_key):
+            if shard_start is None:
+                shard_start = start
+            elif start - shard_start >= shard_size:
+                yield key, (self._path, shard_start, start)
+                shard_start = start
+        if shard_start is not None:
+            yield len(self._starts), (self._path, shard_start, self._end)
+
+    def close(self):
+        if isinstance(self._mm, mmap):
+            self._mm.close()
+        self._fh.close()
+
+
+class StreamMbox:
+    """Forward-only MBOX reader which splits a binary stream at the "From " lines like MmapMbox while reading it
+     in big chunks (e.g. an MBOX file in a ZIP file without extracting it and without seeking in it)
+
+     open_stream is called without arguments to (re)open the stream as a context manager for each iteration
+    """
+
+    def __init__(self, open_stream, chunk_size: int = CHUNK_SIZE):
+        self._open_stream = open_stream
+        self._chunk_size = chunk_size
+        self._len = None
+        self.bytes_read = 0  # The number of bytes parsed by iter_messages() (for throughput reporting)
+
+    def iter_raw(self, first_key: int = 0, headers_only: bool = False):
+        """Yield the raw messages (including the From line) as bytes starting from the first_key-th message
+
+         If headers_only is set, only the header block of the messages is yielded
+        """
+        key = 0
+        with self._open_stream() as fh:
+            # A virtual newline before the stream lets us find the separator at the start of the stream as well
+            buf, msg_start, search_pos = bytearray(b'\n'), None, 0
+            while True:
+                chunk = fh.read(self._chunk_size)
+                buf += chunk
+                # 1. Each message ends where the next one starts (without the empty line before it)
+                pos = buf.find(LINE_SEPARATOR, search_pos)
+                while pos != -1:
+                    if msg_start is not None:
+                        if key >= first_key:
+                            stop = pos + 1
+                            if _previous_line_is_empty(buf, stop):
+                                stop -= len(linesep)
+                            if headers_only:
+                                stop = header_end(buf, msg_start, stop)
+                            yield bytes(buf[msg_start:stop])
+                        key += 1
+                    msg_start = pos + 1  # Skip the newline before the separator
+                    pos = buf.find(LINE_SEPARATOR, msg_start)
+
+                # 2. ... or at the end of the stream
+                if len(chunk) == 0:
+                    if msg_start is not None and key >= first_key:
+                        stop = len(buf)
+                        if _previous_line_is_empty(buf, stop):
+                            stop -= len(linesep)
+                        if headers_only:
+                            stop = header_end(buf, msg_start, stop)
+                        yield bytes(buf[msg_start:stop])
+                    break
+
+                # 3. Keep only the current message (or the possible beginning of a separator before the first message)
+                keep_from = len(buf) - len(LINE_SEPARATOR) + 1
+                if msg_start is not None:
+                    keep_from = msg_start
+                    msg_start = 0
+                del buf[:max(keep_from, 0)]
+                search_pos = max(len(buf) - len(LINE_SEPARATOR) + 1, 0)
+
+    def __len__(self):
+        # The whole stream must be read for this (but the messages are not parsed)!
+        if self._len is None:
+            self._len = sum(1 for _ in self.iter_raw())
+        return self._len
+
+    def __iter__(self):
+        return self.iter_messages()
+
+    def iter_messages(self, first_key: int = 0, headers_only: bool = False, queue_depth: int = 0):
+        """Iterate over the messages starting from the first_key-th message (optionally parsing only the headers)
+
+         If queue_depth is positive, the stream is read (and decompressed) in a background thread
+        """
+        raw_messages = self.iter_raw(first_key, headers_only)
+        if queue_depth > 0:
+            raw_messages = threaded_iter(raw_messages, queue_depth)
+        for raw_message in raw_messages:
+            self.bytes_read += len(raw_message)
+            yield parse_message(raw_message, headers_only)
+
+    def shards(self, shard_size: int, first_key: int = 0, headers_only: bool = False):
+        """Split the messages into lists of raw messages of about shard_size bytes
+
+         Yield (key of the first message after the shard, list of raw messages) pairs
+         (only the header blocks are sent to the workers if headers_only is set)
+        """
+        key, shard, current_size = first_key, [], 0
+        for raw_message in self.iter_raw(first_key, headers_only):
+            shard.append(raw_message)
+            key += 1
+            current_size += len(raw_message)
+            if current_size >= shard_size:
+                yield key, shard
+                shard, current_size = [], 0
+        if len(shard) > 0:
+            yield key, shard
+
+
+@contextmanager
+def _open_zip_member(inp_zip_path: Path, mbox_path_in_zip: Path):
     with ZipFile(inp_zip_path) as zipfh:
         # Zipfile.open() does not yet (?) support Path as filename
         with zipfh.open(str(mbox_path_in_zip)) as mbox_fh:  # bytes
-            if out_mbox_path is not None:
-                with open(out_mbox_path, 'wb') as out_fh:
-                    out_fh.writelines(mbox_fh)
-                ret = mbox(out_mbox_path)
-            else:
-                ret = _mbox_w_fake_open(mbox_fh)
+            yield mbox_fh
+
+
+def _mbox_from_zip_file(inp_zip_path: Path, mbox_path_in_zip: Path, out_mbox_path: Path = None,
+                        use_index: bool = False):
+    """Opens (and optionally extracts) an MBOX file in ZIP files e.g. Google Takeout archives"""
+    if out_mbox_path is not None:
+        with _open_zip_member(inp_zip_path, mbox_path_in_zip) as mbox_fh, open(out_mbox_path, 'wb') as out_fh:
+            copyfileobj(mbox_fh, out_fh, CHUNK_SIZE)
+        ret = MmapMbox(out_mbox_path, use_index=use_index)
+    else:
+        with ZipFile(inp_zip_path) as zipfh:
+            zipfh.getinfo(str(mbox_path_in_zip))  # Raise KeyError now if there is no such file in the ZIP file
+        # The member is decompressed once while iterating over it
+        ret = StreamMbox(partial(_open_zip_member, inp_zip_path, mbox_path_in_zip))
 
     return ret
 
 
-def open_mbox(mbox_path: Path = None, inp_zip_path: Path = None, mbox_path_in_zip: Path = None):
-    """Open plain MBOX file or one in from ZIP file optionally extracting it if all three variables are set"""
-    if mbox_path.is_file():
+def open_mbox(mbox_path: Path = None, inp_zip_path: Path = None, mbox_path_in_zip: Path = None,
+              use_index: bool = False):
+    """Open plain MBOX file or one in from ZIP file optionally extracting it if all three variables are set
+
+     If use_index is set, the message offsets are stored in a sidecar index next to the (extracted) MBOX file
+    """
+    if mbox_path is not None and mbox_path.is_file():
         # a) The MBOX file (mbox_path) is already exists -> Open it
-        my_mbox = mbox(mbox_path)
+        my_mbox = MmapMbox(mbox_path, use_index=use_index)
     elif inp_zip_path is not None and inp_zip_path.is_file() and mbox_path_in_zip is not None:
         # b) ZIP file (inp_zip_path) and MBOX path in ZIP file (mbox_path_in_zip) are supplied to open from the archive
         # c) All three variables are supplied to extract the MBOX path (mbox_path_in_zip)
         #    form ZIP file (inp_zip_path) to the MBOX file (mbox_path)
-        my_mbox = _mbox_from_zip_file(inp_zip_path, mbox_path_in_zip, mbox_path)
+        my_mbox = _mbox_from_zip_file(inp_zip_path, mbox_path_in_zip, mbox_path, use_index)
     else:
         raise ValueError(f'Either mbox_path should be an existing file ({mbox_path}) or'
                          f' both inp_zip_path ({inp_zip_path}) and mbox_path_in_zip (mbox_path_in_zip) should be set!')
 
     return my_mbox
+
+
+class MultiMbox:
+    """Chain of MBOX files (e.g. the members of a split Takeout export) read as one with continuous keys"""
+
+    def __init__(self, members):
+        """members is a list of (name, MmapMbox or StreamMbox) pairs"""
+        self.members = members
+        self.bytes_read = 0  # The number of bytes parsed by iter_messages() (for throughput reporting)
+
+    def __len__(self):
+        # The compressed members must be read entirely for this (but the messages are not parsed)!
+        return sum(len(member) for _, member in self.members)
+
+    def __iter__(self):
+        return self.iter_messages()
+
+    def _first_member(self, first_key):
+        """Return the index of the member containing the first_key-th message, the number of messages before it
+         and the key of the message in it (only the lengths of the members before it are needed)
+        """
+        base = 0
+        for i, (_, member) in enumerate(self.members):
+            if first_key == base:
+                return i, base, 0
+            num_of_messages = len(member)
+            if first_key < base + num_of_messages:
+                return i, base, first_key - base
+            base += num_of_messages
+        return len(self.members), base, 0
+
+    def iter_raw(self, first_key: int = 0, headers_only: bool = False):
+        """Yield the raw messages of the members as bytes starting from the first_key-th message"""
+        first_member, _, key = self._first_member(first_key)
+        for _, member in self.members[first_member:]:
+            yield from member.iter_raw(key, headers_only)
+            key = 0
+
+    def iter_messages(self, first_key: int = 0, headers_only: bool = False, queue_depth: int = 0):
+        """Iterate over the messages of the members starting from the first_key-th message
+
+         If queue_depth is positive, the members are read (and decompressed) in a background thread
+        """
+        raw_messages = self.iter_raw(first_key, headers_only)
+        if queue_depth > 0:
+            raw_messages = threaded_iter(raw_messages, queue_depth)
+        for raw_message in raw_messages:
+            self.bytes_read += len(raw_message)
+            yield parse_message(raw_message, headers_only)
+
+    def shards(self, shard_size: int, first_key: int = 0, headers_only: bool = False):
+        """Chain the shards of the members (the shards of different members are processed concurrently)"""
+        first_member, base, key = self._first_member(first_key)
+        for _, member in self.members[first_member:]:
+            for next_key, shard_source in member.shards(shard_size, key, headers_only):
+                key = next_key
+                yield base + next_key, shard_source
+            base += key  # The key after the last message of the member is its length
+            key = 0
+
+
+def find_mboxes(patterns):
+    """Find the MBOX files (also the gzip, zstd or xz compressed ones) and the MBOX members of ZIP files
+     in the directories (recursively) or files matching the glob patterns (in sorted order)
+
+     The plain MBOX files are memory-mapped, the others are decompressed while read
+    """
+    paths = []
+    for pattern in patterns:
+        for path in sorted(Path(path) for path in glob(pattern, recursive=True)):
+            if path.is_dir():
+                paths.extend(sorted(p for p in path.rglob('*') if p.is_file()))
+            elif path.is_file():
+                paths.append(path)
+
+    members = []
+    for path in dict.fromkeys(paths):  # The files matched by multiple patterns are read only once
+        name = path.name.lower()
+        if name.endswith('.zip'):
+            with ZipFile(path) as zipfh:
+                member_names = [info.filename for info in zipfh.infolist()
+                                if not info.is_dir() and info.filename.lower().endswith('.mbox')]
+            members.extend((f'{path}:{member_name}', StreamMbox(partial(_open_zip_member, path, member_name)))
+                           for member_name in member_names)
+        elif name.endswith('.mbox'):
+            members.append((str(path), MmapMbox(path)))
+        elif name.endswith(COMPRESSED_MBOX_SUFFIXES):
+            members.append((str(path), StreamMbox(partial(open_compressed, path, 'rb'))))
+
+    return members
@@ -0,0 +1,90 @@
+from time import perf_counter
+from functools import partial
+from multiprocessing import Pool
+
+from .stats import Statistics
+from .openers import MmapMbox, parse_message
+from .processing import process_one_email
+from .decoders import decode_cache_info, set_decode_cache_size
+from .instrumentation import timed_iter
+
+
+def _process_shard(shard, final_data=False, stats_kwargs=None, **process_kwargs):
+    """Process the messages of one shard in a worker process
+
+     The shard is either a (path, start, end) byte range of a plain MBOX file or a list of raw messages from a stream.
+     The messages at the skipped indices of the shard (duplicates) are replaced by None in the shard data
+    """
+    next_key, shard_source, skipped = shard
+    headers_only = not process_kwargs.get('process_payload', False)
+    stats = Statistics(**(stats_kwargs or {}))
+    cache_info_before = decode_cache_info()
+    timing = process_kwargs.get('timing', False)
+    shard_data, message_times = [], []
+    if isinstance(shard_source, list):
+        shard_mbox = None
+        messages = (parse_message(raw_message, headers_only) for raw_message in shard_source)
+    else:
+        shard_mbox = MmapMbox(*shard_source)
+        messages = shard_mbox.iter_messages(headers_only=headers_only)
+    if timing:
+        messages = timed_iter(messages, stats.counters)
+    num_of_messages = 0
+    for i, email_obj in enumerate(messages):
+        num_of_messages += 1
+        if i in skipped:
+            stats.counters['duplicates_skipped'] += 1
+            email_data = None
+        else:
+            start = perf_counter() if timing else 0.0
+            email_data = process_one_email(email_obj, stats, **process_kwargs)
+            if timing:
+                message_times.append((i, perf_counter() - start))
+        if final_data:
+            shard_data.append(email_data)
+    if shard_mbox is not None:
+        if timing:
+            stats.counters['bytes_read'] += shard_mbox.bytes_read
+        shard_mbox.close()
+    elif timing:
+        stats.counters['bytes_read'] += sum(len(raw_message) for raw_message in shard_source)
+    stats.counters.update(decode_cache_info() - cache_info_before)
+
+    # The keys of the messages of the shard are known only at the end
+    for i, seconds in message_times:
+        stats.record_message_time(seconds, next_key - num_of_messages + i)
+    if timing:
+        stats.counters['messages'] += len(message_times)
+
+    return next_key, stats, shard_data
+
+
+def _skip_duplicates(shards, first_key, duplicates):
+    """Add the indices of the duplicate messages (by their keys) inside the shards to the shards"""
+    start_key = first_key
+    for next_key, shard_source in shards:
+        skipped = frozenset(key - start_key for key in range(start_key, next_key) if key in duplicates)
+        yield next_key, shard_source, skipped
+        start_key = next_key
+
+
+def process_shards(my_mbox, workers, shard_size, ordered=True, first_key=0, final_data=False, decode_cache_size=None,
+                   stats_kwargs=None, duplicates=frozenset(), **process_kwargs):
+    """Process the shards of the MBOX in a process pool and yield (next_key, stats, email_data_list) tuples
+
+     If ordered, the shards are yielded in the order of the MBOX file, else as they are finished.
+     The messages before the first_key-th message and the ones with their keys in duplicates are skipped
+     (the email data of the latter is None).
+     The decode caches of the workers are set to decode_cache_size if it is not None.
+     The stats_kwargs are passed to the Statistics objects of the shards.
+     The process_kwargs are passed to process_one_email().
+    """
+    process_fun = partial(_process_shard, final_data=final_data, stats_kwargs=stats_kwargs, **process_kwargs)
+    initializer, initargs = None, ()
+    if decode_cache_size is not None:
+        initializer, initargs = set_decode_cache_size, (decode_cache_size,)
+    with Pool(workers, initializer, initargs) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        headers_only = not process_kwargs.get('process_payload', False)
+        shards = _skip_duplicates(my_mbox.shards(shard_size, first_key, headers_only), first_key, duplicates)
+        yield from imap(process_fun, shards)
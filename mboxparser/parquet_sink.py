@@ -0,0 +1,77 @@
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional dependency, only needed for --parquet
+    pa, pq = None, None
+
+from .processing import ADDRESS_HEADER
+
+PARQUET_COMPRESSIONS = ('none', 'snappy', 'gzip', 'brotli', 'lz4', 'zstd')
+
+# Columns with a few distinct values are dictionary encoded, the free texts are not
+DICTIONARY_COLUMNS = ['headers.list.element.name', 'addresses.list.element.header', 'parts.list.element.content_type']
+
+
+def _schema():
+    return pa.schema([('id', pa.int64()),
+                      ('headers', pa.list_(pa.struct([('name', pa.string()), ('position', pa.int32()),
+                                                      ('value', pa.string())]))),
+                      ('addresses', pa.list_(pa.struct([('header', pa.string()), ('position', pa.int32()),
+                                                        ('name', pa.string()), ('address', pa.string())]))),
+                      ('parts', pa.list_(pa.struct([('position', pa.int32()), ('content_type', pa.string()),
+                                                    ('content', pa.string())]))),
+                      ('attachments', pa.list_(pa.struct([('position', pa.int32()), ('filename', pa.string()),
+                                                          ('sha256', pa.string())])))])
+
+
+class ParquetSink:
+    """Write the final (normalised) data into a Parquet file (one row per email) without going through JSON
+
+     The rows are collected column by column and written as a row group of row_group_size emails.
+    """
+
+    def __init__(self, parquet_path: Path, row_group_size: int = 100000, compression: str = 'zstd'):
+        if pa is None:
+            raise ImportError('Writing Parquet files requires pyarrow (pip install pyarrow)!')
+        self._schema = _schema()
+        self._writer = pq.ParquetWriter(parquet_path, self._schema, compression=compression,
+                                        use_dictionary=DICTIONARY_COLUMNS)
+        self._row_group_size = row_group_size
+        self._columns = {name: [] for name in self._schema.names}
+
+    def write(self, email_id: int, email_data: dict):
+        headers, addresses, parts, attachments = [], [], [], []
+        for name, value_list in email_data['headers'].items():
+            for position, value in enumerate(value_list):
+                if name in ADDRESS_HEADER:
+                    addresses.append({'header': name, 'position': position, 'name': value[0], 'address': value[1]})
+                else:
+                    headers.append({'name': name, 'position': position, 'value': value})
+        for position, (content_type, *content) in enumerate(email_data['payload']):
+            if content_type == 'attachment':
+                filename, *sha256 = content
+                attachments.append({'position': position, 'filename': filename,
+                                    'sha256': sha256[0] if sha256 else None})
+            else:
+                parts.append({'position': position, 'content_type': content_type, 'content': content[0]})
+
+        for name, value in zip(self._schema.names, (email_id, headers, addresses, parts, attachments)):
+            self._columns[name].append(value)
+
+        if len(self._columns['id']) >= self._row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the collected rows as a row group"""
+        if len(self._columns['id']) > 0:
+            table = pa.Table.from_pydict(self._columns, schema=self._schema)
+            self._writer.write_table(table, row_group_size=self._row_group_size)
+            for values in self._columns.values():
+                values.clear()
+
+    def close(self):
+        """Write the remaining rows and the footer"""
+        self.flush()
+        self._writer.close()
@@ -1,25 +1,99 @@
-from magic import from_buffer as magic_from_buffer
+from os import getpid
+from hashlib import blake2b
+from time import perf_counter
+
+from magic import Magic
 
 from .decoders import decode_elem, decode_with_fallback
+from .attachments import decode_prefix, estimated_size
+
+# off: never detect the content type,
+# suspicious: only for parts to be decoded as text with their declared charset (where the detected type matters),
+# always: for every non-multipart part (the detected type is also recorded in the statistics)
+SNIFF_POLICIES = ('off', 'suspicious', 'always')
+SNIFF_PREFIX_SIZE = 2048  # bytes
+SNIFF_CACHE_SIZE = 65536
+TEXT_CONTENT_TYPES = {'text/plain', 'text/rfc822-headers', 'text/html'}
+MAX_ENCODED_CHAR_SIZE = 8  # bytes (e.g. UTF-8 needs at most 4, UTF-7 at most 8)
+
+_magic, _magic_pid = None, None
+_sniff_cache = {}
+
+
+def _get_magic():
+    """One libmagic handle per process (the handle inherited through fork() is not used)"""
+    global _magic, _magic_pid
+    if _magic is None or _magic_pid != getpid():
+        _magic, _magic_pid = Magic(mime=True), getpid()
+    return _magic
+
+
+def sniff_content_type(payload, content_type, counters=None):
+    """Detect the MIME type of the payload with libmagic caching the results by declared type and prefix hash"""
+    prefix = payload[:SNIFF_PREFIX_SIZE]
+    key = (content_type, blake2b(prefix, digest_size=16).digest())
+    detected_content_type = _sniff_cache.get(key)
+    if detected_content_type is None:
+        start = perf_counter()
+        detected_content_type = _get_magic().from_buffer(prefix)
+        if counters is not None:
+            counters['sniff_seconds'] += perf_counter() - start
+            counters['sniff_calls'] += 1
+        if len(_sniff_cache) >= SNIFF_CACHE_SIZE:
+            del _sniff_cache[next(iter(_sniff_cache))]  # Drop the oldest entry
+        _sniff_cache[key] = detected_content_type
+    elif counters is not None:
+        counters['sniff_cache_hits'] += 1
+
+    return detected_content_type
+
 
+def _decode_text(payload, content_charset, fallback_charsets, counters, max_text_chars):
+    if max_text_chars == 0:
+        return ''  # The text would be dropped anyway
+    return decode_with_fallback(payload, content_charset, fallback_charsets, counters)
 
-def process_payload_r(email_data, type_count):
+
+def _process_part(email_data, type_count, sniff_policy='always', counters=None, attachment_store=None,
+                  max_attachment_size=None, fallback_charsets=(), max_text_chars=None):
+    """Process one part of the MIME tree (without its subparts) and return whether it is multipart
+     and its output tuple (text or attachment) or None if it has no output
+
+     If max_text_chars is not None, only the prefix of the texts needed for that many characters is decoded
+     (the texts are not decoded at all if it is 0, their content is empty then)
+    """
     # 1. Retrive features
     filename = email_data.get_filename()
     is_multipart = email_data.is_multipart()
     content_type = email_data.get_content_type()
-    payload = email_data.get_payload(decode=True)
     content_charset = email_data.get_content_charset()
     content_disposition = email_data.get_content_disposition()  # Empirically unusable
     coded_payload = email_data.get_payload()  # Helper for has_parts
     has_parts = isinstance(coded_payload, list) and len(coded_payload) > 0
+    # Only the text parts are needed as a whole, for the others (e.g. attachments) the prefix is enough for sniffing
+    is_text = filename is None and (content_charset is not None or content_type in TEXT_CONTENT_TYPES)
+    attachment_size, skip_attachment = None, False
+    if is_multipart:
+        payload = None
+    elif is_text and max_text_chars is not None:
+        payload = decode_prefix(email_data, max(max_text_chars * MAX_ENCODED_CHAR_SIZE, SNIFF_PREFIX_SIZE))
+    elif is_text:
+        payload = email_data.get_payload(decode=True)
+    else:
+        attachment_size = estimated_size(email_data)
+        skip_attachment = max_attachment_size is not None and attachment_size > max_attachment_size
+        # Skipped attachments are not even partially decoded (has_payload remains True)
+        payload = b'' if skip_attachment else decode_prefix(email_data, SNIFF_PREFIX_SIZE)
 
-    # 2. Detect content type if there is content
+    # 2. Detect content type if there is content (and it is needed by the policy)
     detected_content_type, has_payload = None, False
     if payload is not None:
         # Has content (other than list of payload parts which results in None when decode=True in get_payload() )
         has_payload = True
-        detected_content_type = magic_from_buffer(payload[:2048], mime=True)
+        if not skip_attachment and (sniff_policy == 'always' or
+                                    (sniff_policy == 'suspicious' and not is_multipart and filename is None and
+                                     content_charset is not None)):
+            detected_content_type = sniff_content_type(payload, content_type, counters)
     # 3. Decode filename
     if filename is not None:
         filename = decode_elem(filename)
@@ -28,23 +102,29 @@ def process_payload_r(email_data, type_count):
     type_count[(has_payload, is_multipart, has_parts, content_disposition, content_charset, content_type,
                 detected_content_type, filename)] += 1
 
-    # 5. Process parts recursively
-    ret = []
+    # 5. Create the output of the part (the subparts of multiparts are processed by the caller)
+    ret = None
     if is_multipart:  # Emmpirically: is_multipart == not has_payload == has_parts
-        # Multipart -> Iterate subparts and go down a level
-        parts = email_data.get_payload()  # No decoding -> Get the list of subparts
-        for part in parts:
-            ret.extend(process_payload_r(part, type_count))  # Recursion
+        pass
     elif filename is not None:
-        ret.append(('attachment', filename))  # Add attachment filename
-    elif content_charset is None and content_type not in {'text/plain', 'text/rfc822-headers', 'text/html'}:
+        if attachment_store is not None and not skip_attachment:
+            # Stream the attachment to the store and add its content hash as well
+            digest, is_new = attachment_store.store(email_data)
+            if counters is not None:
+                counters['attachments_stored' if is_new else 'attachments_deduplicated'] += 1
+            ret = ('attachment', filename, digest)
+        else:
+            ret = ('attachment', filename)  # Add attachment filename
+        if skip_attachment and counters is not None:
+            counters['attachments_skipped'] += 1
+    elif content_charset is None and content_type not in TEXT_CONTENT_TYPES:
         pass  # Erroneous files (mostly inline images) WITHOUT filename -> Ignore
-    elif content_charset is None and content_type in {'text/plain', 'text/rfc822-headers', 'text/html'}:
+    elif content_charset is None and content_type in TEXT_CONTENT_TYPES:
         # Erroneous texts WITHOUT encoding
         payload = payload.strip()
         if len(payload) > 0:  # Filter dummy (0 long) payloads
-            msg = decode_with_fallback(payload, 'UTF-8')
-            ret.append((content_type, msg))
+            msg = _decode_text(payload, 'UTF-8', fallback_charsets, counters, max_text_chars)
+            ret = (content_type, msg)
     elif (content_charset is not None and detected_content_type in {'application/x-empty',
                                                                     'application/x-bytecode.python',
                                                                     'application/octet-stream',
@@ -55,10 +135,68 @@ def process_payload_r(email_data, type_count):
         # Erroneous texts WITH encoding
         payload = payload.strip()
         if len(payload) > 1:  # Filter dummy (0 or 1 long) payloads e.g. 'g', '.', '-'
-            msg = decode_with_fallback(payload, content_charset)
-            ret.append((content_type, msg))
+            msg = _decode_text(payload, content_charset, fallback_charsets, counters, max_text_chars)
+            ret = (content_type, msg)
     else:  # Not multipart, not has filename, has charset, not eroneous stuff -> Should be OK
-        msg = decode_with_fallback(payload, content_charset)
-        ret.append((content_type, msg))
+        msg = _decode_text(payload, content_charset, fallback_charsets, counters, max_text_chars)
+        ret = (content_type, msg)
+
+    return is_multipart, ret
+
+
+def iter_payload_parts(email_data, type_count, sniff_policy='always', counters=None, attachment_store=None,
+                       max_attachment_size=None, max_depth=None, max_parts=None, max_text_size=None,
+                       fallback_charsets=()):
+    """Walk the MIME tree depth-first (in preorder) without recursion and yield the text and attachment tuples lazily
+
+     The subparts of multiparts nested deeper than max_depth are not processed, the walk stops after max_parts parts
+     and the texts are truncated (then dropped) above max_text_size characters in total (None: no limit)
+     decoding only the prefix of them needed within the limit.
+     The number of times the limits are reached is counted in counters.
+     The undecodable parts of the texts are decoded with the first suitable one of the fallback charsets.
+    """
+    stack = [iter((email_data,))]  # The iterators of the subparts on the path from the root
+    num_of_parts, text_size = 0, 0
+    while len(stack) > 0:
+        part = next(stack[-1], None)
+        if part is None:  # No more subparts on this level -> Go up a level
+            stack.pop()
+            continue
+        if max_parts is not None and num_of_parts >= max_parts:
+            if counters is not None:
+                counters['payload_parts_limited'] += 1
+            break
+        num_of_parts += 1
+
+        max_text_chars = None if max_text_size is None else max_text_size - text_size
+        is_multipart, ret = _process_part(part, type_count, sniff_policy, counters, attachment_store,
+                                          max_attachment_size, fallback_charsets, max_text_chars)
+        if is_multipart:
+            if max_depth is None or len(stack) <= max_depth:
+                stack.append(iter(part.get_payload()))  # Go down a level
+            elif counters is not None:
+                counters['payload_depth_limited'] += 1
+        elif ret is not None:
+            content_type, content = ret[0], ret[1]
+            if content_type != 'attachment' and max_text_size is not None:
+                if text_size >= max_text_size:  # Not even decoded
+                    if counters is not None:
+                        counters['payload_text_limited'] += 1
+                    continue
+                if text_size + len(content) > max_text_size:
+                    if counters is not None:
+                        counters['payload_text_limited'] += 1
+                    content = content[:max_text_size - text_size]
+                    if len(content) == 0:
+                        continue
+                    ret = (content_type, content)
+                text_size += len(content)
+            yield ret
+
 
-    return ret
+def process_payload_r(email_data, type_count, sniff_policy='always', counters=None, attachment_store=None,
+                      max_attachment_size=None, max_depth=None, max_parts=None, max_text_size=None,
+                      fallback_charsets=()):
+    """Process the MIME tree and return the list of text and attachment tuples (see iter_payload_parts())"""
+    return list(iter_payload_parts(email_data, type_count, sniff_policy, counters, attachment_store,
+                                   max_attachment_size, max_depth, max_parts, max_text_size, fallback_charsets))
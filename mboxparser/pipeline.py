@@ -0,0 +1,78 @@
+from queue import Queue
+from threading import Thread
+
+_END = object()  # Marks the end of the items in the queues
+
+
+def threaded_iter(iterable, queue_depth: int):
+    """Iterate over the iterable in a background thread (e.g. reading and decompressing the input)
+     while the caller processes the items already read
+
+     At most queue_depth items are read ahead (backpressure), the exceptions of the thread are raised in the caller
+    """
+    queue = Queue(queue_depth)
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except BaseException as e:
+            queue.put((_END, e))
+        else:
+            queue.put((_END, None))
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        item, exception = queue.get()
+        if item is _END:
+            if exception is not None:
+                raise exception
+            break
+        yield item
+
+
+class ThreadedWriter:
+    """Call the write function in a background thread with the submitted arguments in order
+     (e.g. serializing and writing the output to a slow disk) while the caller processes the next items
+
+     At most queue_depth calls are waiting (backpressure), the exceptions of the thread are raised in the caller
+    """
+
+    def __init__(self, write_fun, queue_depth: int):
+        self._write_fun = write_fun
+        self._queue = Queue(queue_depth)
+        self._exception = None
+        self._thread = Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            args = self._queue.get()
+            try:
+                if args is _END:
+                    break
+                if self._exception is None:  # Drain the queue after an error without writing
+                    self._write_fun(*args)
+            except BaseException as e:
+                self._exception = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_exception(self):
+        if self._exception is not None:
+            raise self._exception
+
+    def submit(self, *args):
+        self._raise_exception()
+        self._queue.put(args)
+
+    def drain(self):
+        """Wait until every submitted call is finished (e.g. before saving a checkpoint)"""
+        self._queue.join()
+        self._raise_exception()
+
+    def close(self):
+        """Finish the submitted calls and stop the thread"""
+        self._queue.put(_END)
+        self._thread.join()
+        self._raise_exception()
@@ -0,0 +1,98 @@
+import sys
+from time import perf_counter
+from email.header import Header
+
+from .dates import normalize_date
+from .payload import iter_payload_parts, process_payload_r
+from .decoders import decode_addresslike_values_cached, decode_elem_cached
+
+ADDRESS_HEADER = {'to', 'from', 'cc', 'bcc', 'delivered-to', 'reply-to', 'sender'}
+
+
+def handle_bad_header(k, v):
+    # Put quirks here if needed!
+    # Quirks can be classified by header names (we use lowercased header names)
+    _ = k
+    return str(v)
+
+
+def process_one_email(email_obj, stats, process_payload=False, verbose=False, lenient_dates=False,
+                      sniff_policy='always', attachment_store=None, max_attachment_size=None, timing=False,
+                      max_payload_depth=None, max_payload_parts=None, max_text_size=None, lazy_payload=False,
+                      fallback_charsets=(), headers=None):
+    # Only the lowercased headers in headers are decoded if it is not None (the others are left out of the output)
+    # The time of the stages is added to stats.counters if timing (see instrumentation.STAGES)
+    # If lazy_payload, the payload is a generator processing the parts when consumed (the statistics are updated then)
+    header_start, date_seconds = perf_counter() if timing else 0.0, 0.0
+
+    # I. Metadata
+    # I/1. Collect the frequency of the varitants of each lowercased header key
+    lower_headers = {}  # Ordered by the first occurrence to make the output independent of the hash seed
+    for k, value_list in email_obj.items():
+        k_lower = k.lower()
+        stats.header_variants[k_lower][k] += 1  # Global lowercased and actual header key variants
+        lower_headers[k_lower] = None  # The actual lowercased which belong to this email object
+
+    # I/2. Iterate over the lowercased header key variants only
+    if headers is not None:
+        lower_headers = [k for k in lower_headers if k in headers]
+    header_value_pairs = {}
+    for k in lower_headers:
+        # get_all() retrieves all casing variant of header key k
+        value_list = email_obj.get_all(k, [])
+        # I/2a. Decode address type headers
+        if k in ADDRESS_HEADER:
+            value_list = decode_addresslike_values_cached(value_list)
+        else:
+            new_value_list = []
+            for val in value_list:
+                # I/2b. Collect bad headers for inspection
+                if isinstance(val, Header):
+                    stats.bad_headers.append((k, val))
+                    val = handle_bad_header(k, val)
+                # I/2c. Parse date (and reformat it to ISO timestamp) and decode other encoded header values
+                if k == 'date':
+                    date_start = perf_counter() if timing else 0.0
+                    try:
+                        val = normalize_date(val)  # Reformat dates to ISO timestamps
+                    except ValueError:
+                        if not lenient_dates:
+                            raise
+                        stats.bad_dates[val] += 1  # Keep the original value
+                    if timing:
+                        date_seconds += perf_counter() - date_start
+                        stats.counters['date_parsing_calls'] += 1
+                elif '=?' in val:
+                    val = decode_elem_cached(val)
+                new_value_list.append(val)
+            value_list = tuple(new_value_list)
+
+        header_value_pairs[k] = value_list
+        stats.headers_dict[k].add(value_list)
+
+    if timing:
+        stats.counters['date_parsing_seconds'] += date_seconds
+        stats.counters['header_decoding_seconds'] += perf_counter() - header_start - date_seconds
+        stats.counters['header_decoding_calls'] += 1
+
+    # II. Payload
+    parts = []
+    if process_payload and lazy_payload:
+        # II/1. Walk the payload later part by part (e.g. to write huge messages part by part)
+        parts = iter_payload_parts(email_obj, stats.payload_type_count, sniff_policy, stats.counters,
+                                   attachment_store, max_attachment_size, max_payload_depth, max_payload_parts,
+                                   max_text_size, fallback_charsets)
+    elif process_payload:
+        payload_start = perf_counter() if timing else 0.0
+        # II/1. Walk the payload and extract text parts (plain text, HTML) and attachment names
+        parts = process_payload_r(email_obj, stats.payload_type_count, sniff_policy, stats.counters, attachment_store,
+                                  max_attachment_size, max_payload_depth, max_payload_parts, max_text_size,
+                                  fallback_charsets)
+        if timing:
+            # The time of libmagic is included here as well
+            stats.counters['payload_seconds'] += perf_counter() - payload_start
+            stats.counters['payload_calls'] += 1
+        if verbose:
+            print('Parts len:', len(parts), file=sys.stderr)
+
+    return {'headers': header_value_pairs, 'payload': parts}
@@ -0,0 +1,43 @@
+from random import Random
+
+from .openers import parse_message
+
+
+def sample_size(num_of_messages, sample):
+    """The number of messages to sample: sample itself (at most all messages) or its fraction of the messages"""
+    if isinstance(sample, float):
+        return round(num_of_messages * sample)
+    return min(sample, num_of_messages)
+
+
+def sample_messages(my_mbox, sample, seed=None, headers_only: bool = False):
+    """Yield (key, message) pairs of randomly sampled messages of the MBOX in the order of the MBOX
+
+     sample is either the number of messages (int) or their fraction (float between 0 and 1).
+     If the MBOX supports random access (by the offsets of the messages), only the sampled messages are read,
+     else the stream is read through and only the sampled messages are parsed:
+     every message is kept with the probability of the fraction or a reservoir of the sampled raw messages is kept
+    """
+    rng = Random(seed)
+    if hasattr(my_mbox, 'get_message'):
+        # 1. Random access
+        keys = sorted(rng.sample(range(len(my_mbox)), sample_size(len(my_mbox), sample)))
+        for key in keys:
+            yield key, my_mbox.get_message(key, headers_only)
+    elif isinstance(sample, float):
+        # 2. Bernoulli sampling of the stream
+        for key, raw_message in enumerate(my_mbox.iter_raw(0, headers_only)):
+            if rng.random() < sample:
+                yield key, parse_message(raw_message, headers_only)
+    else:
+        # 3. Reservoir sampling of the stream (algorithm R)
+        reservoir = []
+        for key, raw_message in enumerate(my_mbox.iter_raw(0, headers_only)):
+            if len(reservoir) < sample:
+                reservoir.append((key, raw_message))
+            else:
+                i = rng.randrange(key + 1)
+                if i < sample:
+                    reservoir[i] = (key, raw_message)
+        for key, raw_message in sorted(reservoir, key=lambda x: x[0]):
+            yield key, parse_message(raw_message, headers_only)
@@ -0,0 +1,55 @@
+from json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # Optional dependency
+    orjson = None
+try:
+    import msgspec
+except ImportError:  # Optional dependency
+    msgspec = None
+
+# json: the standard library (the output is the same as json.dumps(..., ensure_ascii=False)),
+# orjson, msgspec: faster, but the output is compact (no spaces after the separators)
+SERIALIZERS = ('json', 'orjson', 'msgspec')
+WRITE_BUFFER_SIZE = 1024 * 1024  # bytes
+
+
+def get_serializer(name='json'):
+    """Return a function serializing an object to UTF-8 encoded JSON (bytes without newline)"""
+    if name == 'json':
+        encode = JSONEncoder(ensure_ascii=False).encode
+        return lambda obj: encode(obj).encode('UTF-8')
+    elif name == 'orjson':
+        if orjson is None:
+            raise ImportError('The orjson serializer requires orjson (pip install orjson)!')
+        return orjson.dumps
+    elif name == 'msgspec':
+        if msgspec is None:
+            raise ImportError('The msgspec serializer requires msgspec (pip install msgspec)!')
+        return msgspec.json.Encoder().encode
+    raise ValueError(f'Unknown serializer ({name})! Options are {SERIALIZERS} !')
+
+
+class BufferedRecordWriter:
+    """Collect the serialized records (JSON Lines) and write them to a binary file handle in large batches"""
+
+    def __init__(self, fh, buffer_size: int = WRITE_BUFFER_SIZE):
+        self._fh = fh
+        self._buffer_size = buffer_size
+        self._records = []
+        self._size = 0
+
+    def write(self, record: bytes):
+        self._records.append(record)
+        self._records.append(b'\n')
+        self._size += len(record) + 1
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the collected records to the file handle (the file handle itself is not flushed)"""
+        if len(self._records) > 0:
+            self._fh.write(b''.join(self._records))
+            self._records.clear()
+            self._size = 0
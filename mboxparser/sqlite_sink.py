@@ -0,0 +1,90 @@
+import sqlite3
+from pathlib import Path
+
+from .processing import ADDRESS_HEADER
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS emails (id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS headers (email_id INTEGER NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL,
+                                    value TEXT);
+CREATE TABLE IF NOT EXISTS addresses (email_id INTEGER NOT NULL, header TEXT NOT NULL, position INTEGER NOT NULL,
+                                      name TEXT, address TEXT);
+CREATE TABLE IF NOT EXISTS parts (id INTEGER PRIMARY KEY, email_id INTEGER NOT NULL, position INTEGER NOT NULL,
+                                  content_type TEXT, content TEXT);
+CREATE TABLE IF NOT EXISTS attachments (email_id INTEGER NOT NULL, position INTEGER NOT NULL, filename TEXT,
+                                        sha256 TEXT);
+'''
+
+# Built once at the end as it is much faster than updating them on every insert
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS headers_email_id ON headers (email_id);
+CREATE INDEX IF NOT EXISTS headers_name_value ON headers (name, value);
+CREATE INDEX IF NOT EXISTS addresses_email_id ON addresses (email_id);
+CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address);
+CREATE INDEX IF NOT EXISTS parts_email_id ON parts (email_id);
+CREATE INDEX IF NOT EXISTS attachments_email_id ON attachments (email_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS parts_fts USING fts5(content, content='parts', content_rowid='id');
+INSERT INTO parts_fts(parts_fts) VALUES('rebuild');
+'''
+
+TABLES = ('headers', 'addresses', 'parts', 'attachments')
+
+
+class SQLiteSink:
+    """Write the final (normalised) data into normalised SQLite tables with a full-text index on the text parts
+
+     Rows are collected and inserted with executemany() in one transaction per batch_size emails.
+     The emails after first_id are deleted from an existing database (to continue an incremental or resumed run).
+    """
+
+    def __init__(self, db_path: Path, first_id: int = 0, batch_size: int = 10000):
+        # Transactions are handled explicitly, the rows may be written from a writer thread (one thread at a time)
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL')  # The database remains consistent if the process is killed
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.executescript(SCHEMA)
+        self._conn.execute('BEGIN')
+        self._conn.execute('DELETE FROM emails WHERE id > ?', (first_id,))
+        for table in TABLES:
+            self._conn.execute(f'DELETE FROM {table} WHERE email_id > ?', (first_id,))
+        self._conn.execute('COMMIT')
+
+        self._batch_size = batch_size
+        self._rows = {'emails': [], **{table: [] for table in TABLES}}
+
+    def write(self, email_id: int, email_data: dict):
+        self._rows['emails'].append((email_id,))
+        for name, value_list in email_data['headers'].items():
+            for position, value in enumerate(value_list):
+                if name in ADDRESS_HEADER:
+                    self._rows['addresses'].append((email_id, name, position, *value))
+                else:
+                    self._rows['headers'].append((email_id, name, position, value))
+        for position, (content_type, *content) in enumerate(email_data['payload']):
+            if content_type == 'attachment':
+                filename, *sha256 = content
+                self._rows['attachments'].append((email_id, position, filename, sha256[0] if sha256 else None))
+            else:
+                self._rows['parts'].append((email_id, position, content_type, content[0]))
+
+        if len(self._rows['emails']) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert the collected rows in one transaction"""
+        self._conn.execute('BEGIN')
+        self._conn.executemany('INSERT INTO emails (id) VALUES (?)', self._rows['emails'])
+        self._conn.executemany('INSERT INTO headers VALUES (?, ?, ?, ?)', self._rows['headers'])
+        self._conn.executemany('INSERT INTO addresses VALUES (?, ?, ?, ?, ?)', self._rows['addresses'])
+        self._conn.executemany('INSERT INTO parts (email_id, position, content_type, content) VALUES (?, ?, ?, ?)',
+                               self._rows['parts'])
+        self._conn.executemany('INSERT INTO attachments VALUES (?, ?, ?, ?)', self._rows['attachments'])
+        self._conn.execute('COMMIT')
+        for rows in self._rows.values():
+            rows.clear()
+
+    def close(self):
+        """Insert the remaining rows, build the indexes and the full-text index"""
+        self.flush()
+        self._conn.executescript(INDEXES)
+        self._conn.close()
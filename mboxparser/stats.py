@@ -0,0 +1,160 @@
+import sys
+from pathlib import Path
+from heapq import heappush, heappushpop, nlargest, heapify
+from functools import partial
+from collections import Counter, defaultdict
+from pickle import dump as pickle_dump, load as pickle_load
+
+DEFAULT_HEADER_TOP_K = 1000
+SLOWEST_MESSAGES = 10
+
+
+def _intern_value(value):
+    """Intern the strings of a (nested) header value tuple to store the repeated ones only once"""
+    if type(value) is str:  # sys.intern() does not accept subclasses
+        return sys.intern(value)
+    elif isinstance(value, tuple):
+        return tuple(_intern_value(elem) for elem in value)
+    return value
+
+
+class HeaderValueCounter(Counter):
+    """Counter of the values of a header which becomes a bounded heavy-hitter sketch above max_exact distinct values
+
+     The counts are exact until the number of distinct values exceeds max_exact (None: always exact).
+     Afterwards only the top_k most frequent values are kept (Misra-Gries summary, the deterministic counterpart
+     of Space-Saving) and their counts are underestimated by at most total() / (top_k + 1).
+     The counts taken from the kept values are accumulated in dropped, so total() remains exact.
+    """
+
+    def __init__(self, max_exact=None, top_k=DEFAULT_HEADER_TOP_K):
+        super().__init__()
+        self.max_exact = max_exact
+        self.top_k = top_k
+        self.sketched = False
+        self.dropped = 0
+
+    def __reduce__(self):
+        # Counter.__reduce__() would drop the attributes
+        return self.__class__, (self.max_exact, self.top_k), self.__dict__, None, iter(self.items())
+
+    def add(self, value, count=1):
+        """Count value (the strings of the new values are interned)"""
+        if value in self:
+            self[value] += count
+        else:
+            self[_intern_value(value)] = count
+            self._bound()
+
+    def merge(self, other):
+        """Add the counts of an other counter (Misra-Gries summaries remain valid when merged)"""
+        for value, count in other.items():
+            if value in self:
+                self[value] += count
+            else:
+                self[value] = count
+        self.dropped += getattr(other, 'dropped', 0)
+        self.sketched |= getattr(other, 'sketched', False)
+        self._bound()
+
+    def _bound(self):
+        if not self.sketched and self.max_exact is not None and len(self) > self.max_exact:
+            self.sketched = True
+        # The summary is pruned back to top_k values only when it doubled to amortise the cost of sorting
+        if self.sketched and len(self) > 2 * self.top_k:
+            self._prune()
+
+    def _prune(self):
+        """Subtract the (top_k + 1)-th largest count from every count and drop the non-positive ones"""
+        counts = sorted(self.values(), reverse=True)
+        if len(counts) <= self.top_k:
+            return
+        decrement = counts[self.top_k]
+        for value, count in list(self.items()):
+            if count > decrement:
+                self[value] = count - decrement
+            else:
+                del self[value]
+        self.dropped += sum(min(count, decrement) for count in counts)
+
+    def total(self):
+        """The number of counted values (exact even if sketched)"""
+        return super().total() + self.dropped
+
+
+class Statistics:
+    """The statistics collected while processing emails which can be merged (e.g. from parallel workers)
+
+     The values of the headers with more than max_exact_values distinct values are counted approximately
+     (only their top_k most frequent values are kept, see HeaderValueCounter).
+     The num_of_slowest_messages slowest messages are kept (if timed)
+    """
+    num_of_slowest_messages = SLOWEST_MESSAGES  # Also for the objects pickled before it was configurable
+
+    def __init__(self, max_exact_values=None, top_k=DEFAULT_HEADER_TOP_K, num_of_slowest_messages=SLOWEST_MESSAGES):
+        # header_key -> header_value -> header_value_freq
+        self.headers_dict = defaultdict(partial(HeaderValueCounter, max_exact_values, top_k))
+        self.header_variants = defaultdict(Counter)
+        # features_tuple -> features_tuple_freq
+        self.payload_type_count = Counter()
+        self.bad_headers = []
+        # raw_date_value -> raw_date_value_freq (with lenient date parsing)
+        self.bad_dates = Counter()
+        # Named counters of the processing itself (e.g. cache hits)
+        self.counters = Counter()
+        # (seconds, key) heap of the slowest messages (only if timed)
+        self.slowest_messages = []
+        self.num_of_slowest_messages = num_of_slowest_messages
+
+    def record_message_time(self, seconds, key):
+        """Keep the key of the message if it is among the num_of_slowest_messages slowest ones"""
+        if len(self.slowest_messages) < self.num_of_slowest_messages:
+            heappush(self.slowest_messages, (seconds, key))
+        elif seconds > self.slowest_messages[0][0]:
+            heappushpop(self.slowest_messages, (seconds, key))
+
+    def update(self, other):
+        """Add the counts of an other Statistics object (the order of first occurrences is kept if merged in order)"""
+        for k, v in other.headers_dict.items():
+            self.headers_dict[k].merge(v)
+        for k, v in other.header_variants.items():
+            self.header_variants[k].update(v)
+        self.payload_type_count.update(other.payload_type_count)
+        self.bad_headers.extend(other.bad_headers)
+        self.bad_dates.update(other.bad_dates)
+        self.counters.update(other.counters)
+        self.slowest_messages = nlargest(self.num_of_slowest_messages, self.slowest_messages + other.slowest_messages)
+        heapify(self.slowest_messages)
+
+
+def stats_path_for(mbox_path: Path):
+    """The aggregated statistics of incremental runs are stored next to the MBOX file"""
+    return mbox_path.with_name(f'{mbox_path.name}.stats')
+
+
+def save_statistics(stats_path: Path, stats: Statistics, my_mbox, process_payload: bool):
+    """Store the statistics with the number and the hash of the last processed message to continue from there"""
+    num_of_messages = len(my_mbox)
+    last_hash = my_mbox.message_hash(num_of_messages - 1) if num_of_messages > 0 else b''
+    with open(stats_path, 'wb') as fh:
+        pickle_dump({'messages': num_of_messages, 'last_hash': last_hash, 'process_payload': process_payload,
+                     'stats': stats}, fh)
+
+
+def load_statistics(stats_path: Path, my_mbox, process_payload: bool):
+    """Load the stored statistics and return them with the number of messages already processed
+
+     Raise ValueError if the stored statistics do not belong to (the beginning of) the MBOX file
+    """
+    with open(stats_path, 'rb') as fh:
+        stored = pickle_load(fh)
+
+    num_of_messages = stored['messages']
+    if stored['process_payload'] != process_payload:
+        raise ValueError(f'The statistics ({stats_path}) were created with different payload processing setting!')
+    if num_of_messages > len(my_mbox) or \
+            (num_of_messages > 0 and my_mbox.message_hash(num_of_messages - 1) != stored['last_hash']):
+        raise ValueError(f'The statistics ({stats_path}) do not belong to the beginning of the MBOX file!'
+                         f' Remove it to start over!')
+
+    return stored['stats'], num_of_messages
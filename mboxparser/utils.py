@@ -1,11 +1,41 @@
 import sys
+import codecs
+import gzip
+import lzma
 from typing import Union
 from pathlib import Path
 from argparse import ArgumentTypeError
 
+try:
+    import zstandard
+except ImportError:  # Optional dependency, only needed for .zst files
+    zstandard = None
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst', '.xz')  # Opened by open_compressed()
+
+
+def open_compressed(path: Union[Path, str], mode: str = 'r', **kwargs):
+    """Open (streaming) gzip, zstd and xz compressed files by their extension (see COMPRESSED_SUFFIXES)
+     and plain files otherwise
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == '.gz':
+        if 'b' not in mode:
+            mode = f'{mode}t'  # gzip.open() defaults to binary mode
+        return gzip.open(path, mode, **kwargs)
+    elif suffix == '.xz':
+        if 'b' not in mode:
+            mode = f'{mode}t'  # lzma.open() defaults to binary mode
+        return lzma.open(path, mode, **kwargs)
+    elif suffix == '.zst':
+        if zstandard is None:
+            raise ImportError(f'Opening {path} requires zstandard (pip install zstandard)!')
+        return zstandard.open(path, mode, **kwargs)
+    return open(path, mode, **kwargs)
+
 
 class OpenFileOrSTDStreams:
-    """Unified opener for files and STD streams (STDIN, STDOUT)"""
+    """Unified opener for files (also compressed ones, see open_compressed()) and STD streams (STDIN, STDOUT)"""
     _MODE_FOR_STD_STREAMS = {'r': sys.stdin,
                              'rb': sys.stdin.buffer,
                              'w': sys.stdout,
@@ -31,7 +61,7 @@ class OpenFileOrSTDStreams:
 
     def __enter__(self):
         if self._fh is None:
-            self._fh = open(self._path, self._mode, **self._kwargs)
+            self._fh = open_compressed(self._path, self._mode, **self._kwargs)
         return self._fh
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
@@ -56,3 +86,39 @@ def existing_file(string):
         raise ArgumentTypeError(f'{string} does not an existing file!')
 
     return stirng_path
+
+
+def positive_int(string):
+    try:
+        value = int(string)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise ArgumentTypeError(f'{string} is not a positive integer!')
+
+    return value
+
+
+def known_charset(string):
+    try:
+        codecs.lookup(string)
+    except LookupError:
+        raise ArgumentTypeError(f'{string} is not a known charset!')
+
+    return string
+
+
+def sample_size_or_fraction(string):
+    try:
+        value = int(string)
+    except ValueError:
+        try:
+            value = float(string)
+        except ValueError:
+            value = 0
+        if not 0.0 < value < 1.0:
+            raise ArgumentTypeError(f'{string} is neither a positive integer nor a fraction between 0 and 1!')
+    if value <= 0:
+        raise ArgumentTypeError(f'{string} is neither a positive integer nor a fraction between 0 and 1!')
+
+    return value